@@ -53,6 +53,7 @@ genmodel_params.add_argument('--g-fc-uni', type=int, help='[fc_units] in generat
 gen_params = parser.add_argument_group('Generator Hyper Parameters')
 gen_params.add_argument('--g-iters', type=int, help="# batches to train generator (default: as classifier)")
 gen_params.add_argument('--lr-gen', type=float, help="learning rate generator (default: lr)")
+gen_params.add_argument('--gen-worker', action='store_true', help="train generator in separate process")
 
 # "memory allocation" parameters
 cl_params = parser.add_argument_group('Memory Allocation Parameters')
@@ -1,11 +1,38 @@
 import abc
+import os
 import numpy as np
 import torch
 from torch import nn
 from torch.nn import functional as F
+try:
+    from torch.func import functional_call, grad, vmap
+except ImportError:
+    functional_call = grad = vmap = None
+import excitability_modules as em
 import utils
 
 
+class _FlatQuadraticPenalty(torch.autograd.Function):
+    '''Compute sum(precision * (theta-mean)**2) for flat <tensor> [theta] that holds the values of all [params].
+
+    The gradient is computed in a single vectorized operation on the flat tensors, and is returned to each parameter in
+    [params] as a view (of size [sizes]) into it.'''
+
+    @staticmethod
+    def forward(ctx, theta, mean, precision, sizes, *params):
+        ctx.diff = theta-mean
+        ctx.precision = precision
+        ctx.sizes = sizes
+        ctx.shapes = [p.shape for p in params]
+        return (precision * ctx.diff**2).sum()
+
+    @staticmethod
+    def backward(ctx, grad_output):
+        grad_theta = (2*grad_output) * ctx.precision * ctx.diff
+        grads = [g.view(shape) for g, shape in zip(grad_theta.split(ctx.sizes), ctx.shapes)]
+        return (None, None, None, None, *grads)
+
+
 class ContinualLearner(nn.Module, metaclass=abc.ABCMeta):
     '''Abstract module to add continual learning capabilities to a classifier.
 
@@ -17,7 +44,7 @@ class ContinualLearner(nn.Module, metaclass=abc.ABCMeta):
 
         # XdG:
         self.mask_dict = None        # -> <dict> with task-specific masks for each hidden fully-connected layer
-        self.excit_buffer_list = []  # -> <list> with excit-buffers for all hidden fully-connected layers
+        self.XdG_layers = []         # -> <list> with all hidden fully-connected layers (with precomputed masks)
 
         # -SI:
         self.si_c = 0           #-> hyperparam: how strong to weigh SI-loss ("regularisation strength")
@@ -29,7 +56,26 @@ class ContinualLearner(nn.Module, metaclass=abc.ABCMeta):
         self.online = True      #-> "online" (=single quadratic term) or "offline" (=quadratic term per task) EWC
         self.fisher_n = None    #-> sample size for estimating FI-matrix (if "None", full pass over dataset)
         self.emp_FI = False     #-> if True, use provided labels to calculate FI ("empirical FI"); else predicted labels
+        self.fisher_batch = 1   #-> # of samples for which gradients are computed at once when estimating FI-matrix
+        self.fisher_tol = None  #-> if not None, stop estimating FI-matrix once relative change of its norm is below it
+        self.fisher_chunk = 128 #-> # of samples after which convergence of estimated FI-matrix is checked
+        self.fisher_n_used = [] #-> keeps track of # of samples used for each estimation of the FI-matrix
         self.EWC_task_count = 0 #-> keeps track of number of quadratic loss terms (for "offline EWC")
+        self.consolidate_EWC = False #-> "offline EWC": store the sum of the quadratic terms of all tasks as single
+                                     #   quadratic term (plus constant), so its cost does not grow with the # of tasks
+        self.EWC_task_dir = None     #-> if not None, directory to which mode and precision of each task are saved
+                                     #   (only for "offline EWC" with [consolidate_EWC])
+
+        # -EWC & SI:
+        self.importance_storage = "float" #-> how to store EWC's precision & SI's omega: "float", "bfloat16", "float16"
+                                          #   or "topk" (only largest values, with their indeces)
+        self.importance_topk = 0.1        #-> if "topk", proportion of entries to keep
+        self.inject_reg_grads = False #-> add gradients of EWC- and SI-losses directly to [p.grad] (without autograd),
+                                      #   their values are then only computed if requested (e.g., for logging)
+
+        # Parameter arena:
+        self.param_arena = None #-> if not None, <tensor> of which all trainable parameters are views
+        self.grad_arena = None  #-> if not None, <tensor> of which the gradients of all trainable parameters are views
 
     def _device(self):
         return next(self.parameters()).device
@@ -42,101 +88,443 @@ class ContinualLearner(nn.Module, metaclass=abc.ABCMeta):
         pass
 
 
+    #----------------- Parameter arena -----------------#
+
+    def build_param_arena(self):
+        '''Make all trainable parameters (and their gradients) views into one contiguous <tensor>.
+
+        The A-GEM projection, the SI path-integral and the EWC- and SI-losses then all use single vectorized operations
+        on [self.param_arena] and [self.grad_arena], and the EWC- and SI-state is stored in matching flat buffers.
+        NOTE: this should be done after the model is moved to its device (and before EWC or SI state is stored).'''
+
+        params = [p for p in self.parameters() if p.requires_grad]
+        self.arena_sizes = [p.numel() for p in params]
+        self.param_arena = torch.cat([p.detach().reshape(-1) for p in params])
+        self.grad_arena = torch.zeros_like(self.param_arena)
+        for p, p_flat, g_flat in zip(params, self.param_arena.split(self.arena_sizes),
+                                     self.grad_arena.split(self.arena_sizes)):
+            p.data = p_flat.view_as(p)
+            p.grad = g_flat.view_as(p)
+
+    def zero_grad_arena(self):
+        '''Reset gradients to zero, keeping them in place (so they remain views into [self.grad_arena]).'''
+        self.grad_arena.zero_()
+
+    def _flat_penalty(self, mean, precision):
+        '''Calculate sum(precision * (p-mean)**2) over all trainable parameters, with [mean] and [precision] flat.'''
+        params = [p for p in self.parameters() if p.requires_grad]
+        return _FlatQuadraticPenalty.apply(self.param_arena, mean, precision, self.arena_sizes, *params)
+
+
     #----------------- XdG-specifc functions -----------------#
 
+    def build_XdGmasks(self, layers, sparse=False):
+        '''Precompute for each layer in [layers] the masks of all tasks in [self.mask_dict].
+
+        For the i-th layer, the masks are stored as buffer [XdG_masks] with shape (tasks+1)x(units) on the device of the
+        layer, with row 0 the "unit mask" (i.e., no masking) and row [task] the mask of that task. Switching masks then
+        only requires pointing the layer's "excit-buffer" to a row of this table.
+
+        [layers]    <list> with <LinearExcitability>-layers (with "excit-buffer"), in order of [self.mask_dict][task]
+        [sparse]    <bool>, if True, the indeces of the units that are not gated are stored as well (as buffer
+                        [XdG_active_units] with shape (tasks)x(active units)), so that while a task-specific mask is
+                        applied, each layer only computes the output of these units'''
+
+        assert self.mask_dict is not None
+        for i, layer in enumerate(layers):
+            masks = torch.ones(len(self.mask_dict)+1, len(layer.excit_buffer), device=layer.excit_buffer.device,
+                               dtype=layer.excit_buffer.dtype)
+            for task, task_masks in self.mask_dict.items():
+                masks[task, torch.as_tensor(task_masks[i], dtype=torch.long)] = 0.  # -> set task-specific mask
+            layer.register_buffer('XdG_masks', masks)
+            if sparse:
+                layer.register_buffer('XdG_active_units', torch.stack([
+                    masks[task].nonzero().squeeze(1) for task in range(1, len(self.mask_dict)+1)
+                ]))
+        self.XdG_layers = list(layers)
+
     def apply_XdGmask(self, task):
         '''Apply task-specific mask, by setting activity of pre-selected subset of nodes to zero.
 
         [task]   <int>, starting from 1'''
 
         assert self.mask_dict is not None
-        torchType = next(self.parameters()).detach()
-
-        # Loop over all buffers for which a task-specific mask has been specified
-        for i,excit_buffer in enumerate(self.excit_buffer_list):
-            gating_mask = np.repeat(1., len(excit_buffer))
-            gating_mask[self.mask_dict[task][i]] = 0.      # -> find task-specifc mask
-            excit_buffer.set_(torchType.new(gating_mask))  # -> apply this mask
+        for layer in self.XdG_layers:
+            layer.set_excit_buffer(layer.XdG_masks[task], identity=False)  # -> apply this mask
+            if getattr(layer, 'XdG_active_units', None) is not None:
+                layer.active_units = layer.XdG_active_units[task-1]
 
     def reset_XdGmask(self):
         '''Remove task-specific mask, by setting all "excit-buffers" to 1.'''
-        torchType = next(self.parameters()).detach()
-        for excit_buffer in self.excit_buffer_list:
-            gating_mask = np.repeat(1., len(excit_buffer))  # -> define "unit mask" (i.e., no masking at all)
-            excit_buffer.set_(torchType.new(gating_mask))   # -> apply this unit mask
+        for layer in self.XdG_layers:
+            layer.set_excit_buffer(layer.XdG_masks[0], identity=True)  # -> apply "unit mask" (i.e., no masking at all)
+            layer.active_units = None
+
+
+    #----------------- EWC- & SI-specifc functions -----------------#
+
+    def _register_importance(self, name, importance):
+        '''Register [importance] (i.e., EWC's precision or SI's omega) as buffer [name], in the format specified by
+        [self.importance_storage]. With "topk", only the largest values are stored (with their indeces in [name]_index).'''
+        if self.importance_storage=="topk":
+            flat_importance = importance.reshape(-1)
+            k = max(1, int(round(self.importance_topk * flat_importance.numel())))
+            values, index = flat_importance.topk(k, sorted=False)
+            self.register_buffer('{}_index'.format(name), index)
+            self.register_buffer(name, values)
+        elif self.importance_storage in ("bfloat16", "float16"):
+            self.register_buffer(name, importance.to(getattr(torch, self.importance_storage)))
+        else:
+            self.register_buffer(name, importance)
+
+    def _get_importance(self, name, like):
+        '''Return importance-buffer [name] as dense <tensor> with same size and type as [like].'''
+        importance = getattr(self, name)
+        index = getattr(self, '{}_index'.format(name), None)
+        if index is None:
+            return importance.to(like.dtype)
+        dense = torch.zeros_like(like).reshape(-1)
+        dense[index] = importance.to(like.dtype)
+        return dense.view_as(like)
+
+    def _quadratic_penalty(self, name, p, anchor):
+        '''Return sum(importance * (p-anchor)**2), with importance stored as buffer [name] (in any storage format).'''
+        index = getattr(self, '{}_index'.format(name), None)
+        if index is None:
+            return (getattr(self, name) * (p-anchor)**2).sum()
+        return (getattr(self, name) * (p.reshape(-1)[index]-anchor.reshape(-1)[index])**2).sum()
+
+    def _add_quadratic_grad(self, grad, name, p, anchor, scale):
+        '''Add [scale]*importance*(p-anchor) to [grad], with importance stored as buffer [name] (in any format).'''
+        index = getattr(self, '{}_index'.format(name), None)
+        if index is None:
+            grad.addcmul_(getattr(self, name), p-anchor, value=scale)
+        else:
+            diff = p.reshape(-1)[index]-anchor.reshape(-1)[index]
+            grad.view(-1).index_add_(0, index, scale * getattr(self, name) * diff)
+
+    def add_regularizer_grads(self):
+        '''Add gradients of weighted EWC-loss (i.e., [ewc_lambda]*F*(p-mean)) and weighted SI-loss (i.e.,
+        2*[si_c]*omega*(p-p_prev)) directly to the gradients of the parameters, without using autograd.'''
+
+        ewc_scale = self.ewc_lambda*self.gamma if self.online else self.ewc_lambda
+        use_ewc = (self.ewc_lambda>0) and (self.EWC_task_count>0)
+        use_si = self.si_c>0
+
+        with torch.no_grad():
+            # -if using parameter arena, do this with single operations on the flat tensors
+            if self.param_arena is not None:
+                if use_ewc:
+                    for suffix in self._EWC_terms():
+                        mean = getattr(self, 'EWC_prev_task{}'.format(suffix))
+                        fisher = getattr(self, 'EWC_estimated_fisher{}'.format(suffix))
+                        self.grad_arena.addcmul_(fisher, self.param_arena-mean, value=ewc_scale)
+                if use_si and (getattr(self, 'SI_omega', None) is not None):
+                    self.grad_arena.addcmul_(self.SI_omega, self.param_arena-self.SI_prev_task, value=2*self.si_c)
+            # -otherwise, loop over all parameters
+            else:
+                for n, p in self.named_parameters():
+                    if p.requires_grad:
+                        n = n.replace('.', '__')
+                        if p.grad is None:
+                            p.grad = torch.zeros_like(p)
+                        if use_ewc:
+                            for suffix in self._EWC_terms():
+                                mean = getattr(self, '{}_EWC_prev_task{}'.format(n, suffix))
+                                self._add_quadratic_grad(p.grad, '{}_EWC_estimated_fisher{}'.format(n, suffix), p, mean,
+                                                         scale=ewc_scale)
+                        if use_si and hasattr(self, '{}_SI_omega'.format(n)):
+                            p_prev = getattr(self, '{}_SI_prev_task'.format(n))
+                            self._add_quadratic_grad(p.grad, '{}_SI_omega'.format(n), p, p_prev, scale=2*self.si_c)
 
 
     #----------------- EWC-specifc functions -----------------#
 
+    def _EWC_terms(self):
+        '''Return <list> with for each stored quadratic EWC-term the suffix of the names of its buffers.'''
+        single_term = self.online or self.consolidate_EWC
+        return [""] if single_term else list(range(1, self.EWC_task_count+1))
+
+    @staticmethod
+    def _merge_EWC_terms(mean, precision, new_mean, new_precision):
+        '''Write [precision]*(p-[mean])**2 + [new_precision]*(p-[new_mean])**2 as a single quadratic term plus a
+        constant, and return mean and precision of that term and the constant (summed over all entries).'''
+        precision_sum = precision + new_precision
+        nonzero = precision_sum>0
+        precision_sum_ = torch.where(nonzero, precision_sum, torch.ones_like(precision_sum))
+        merged_mean = torch.where(nonzero, (precision*mean + new_precision*new_mean)/precision_sum_, new_mean)
+        constant = (precision*new_precision/precision_sum_ * (mean-new_mean)**2).sum()
+        return merged_mean, precision_sum, constant
+
+    def _save_EWC_task_term(self, mean, fisher):
+        '''Save mode and precision (as <dicts> or flat <tensors>) of the task just completed to [self.EWC_task_dir].'''
+        if not os.path.exists(self.EWC_task_dir):
+            os.makedirs(self.EWC_task_dir)
+        to_cpu = lambda t: {n: v.cpu() for n, v in t.items()} if isinstance(t, dict) else t.cpu()
+        torch.save({'mean': to_cpu(mean), 'fisher': to_cpu(fisher)},
+                   os.path.join(self.EWC_task_dir, 'EWC_task{}.pt'.format(self.EWC_task_count+1)))
+
+    def _linear_modules(self):
+        '''Return <list> with (name, module) for all modules with trainable parameters if all of them are linear layers
+        (for which squared per-sample gradients can be computed in closed form), otherwise return None.'''
+        modules = [(name, module) for name, module in self.named_modules() if any(
+            p.requires_grad for p in module.parameters(recurse=False)
+        )]
+        linear = all(isinstance(module, (em.LinearExcitability, nn.Linear)) for _, module in modules)
+        return modules if linear else None
+
+    def _squared_grads_closed_form(self, x, label, allowed_classes, modules):
+        '''Return <dict> with for each parameter the sum over samples in [x] of its squared per-sample gradient of the
+        negative log-likelihood of [label] (if None, of the predicted label), for linear layers [modules] (which should
+        contain all trainable parameters). Per-sample gradients of weights are outer products of per-sample gradients
+        w.r.t. the layer's outputs and its inputs, so the sum of their squares is a single matrix product.'''
+
+        # Run forward pass, while storing inputs and outputs of all linear layers
+        activations = {}
+        hooks = [module.register_forward_hook(
+            lambda module, input, output: activations.__setitem__(module, (input[0], output))
+        ) for _, module in modules]
+        try:
+            output = self(x)
+        finally:
+            for hook in hooks:
+                hook.remove()
+        output = output if allowed_classes is None else output[:, allowed_classes]
+        label = output.max(1)[1] if (label is None) else label
+
+        # Calculate gradients w.r.t. outputs of all linear layers (as the negative log-likelihoods of all samples are
+        # summed, and the model is in eval-mode, these are the per-sample gradients)
+        negloglikelihood = F.nll_loss(F.log_softmax(output, dim=1), label, reduction='sum')
+        grad_outputs = torch.autograd.grad(negloglikelihood, [activations[module][1] for _, module in modules])
+
+        # Square per-sample gradients of all parameters and sum them over the samples
+        squared_grads = {}
+        with torch.no_grad():
+            for (name, module), grad_output in zip(modules, grad_outputs):
+                input = activations[module][0]
+                prefix = name.replace('.', '__') + ('__' if name else '')
+                excitability = getattr(module, 'excitability', None)
+                excit_buffer = getattr(module, 'excit_buffer', None)
+                if excitability is None:
+                    total_excitability = excit_buffer
+                else:
+                    total_excitability = excitability if excit_buffer is None else excitability*excit_buffer
+                grad_pre = grad_output if (total_excitability is None) else grad_output*total_excitability
+                if module.weight.requires_grad:
+                    squared_grads[prefix+'weight'] = (grad_pre**2).t().matmul(input**2)
+                if (module.bias is not None) and module.bias.requires_grad:
+                    squared_grads[prefix+'bias'] = (grad_output**2).sum(dim=0)
+                if (excitability is not None) and excitability.requires_grad:
+                    grad_excitability = grad_output * input.matmul(module.weight.t())
+                    if excit_buffer is not None:
+                        grad_excitability = grad_excitability*excit_buffer
+                    squared_grads[prefix+'excitability'] = (grad_excitability**2).sum(dim=0)
+        return squared_grads
+
+    def _squared_grads_vmap(self, x, label, allowed_classes):
+        '''Return <dict> with for each parameter the sum over samples in [x] of its squared per-sample gradient of the
+        negative log-likelihood of [label] (if None, of the predicted label), using [torch.func].'''
+
+        params = {n: p.detach() for n, p in self.named_parameters() if p.requires_grad}
+
+        def negloglikelihood(params, x_i, label_i):
+            output = functional_call(self, params, (x_i.unsqueeze(0),))
+            output = output if allowed_classes is None else output[:, allowed_classes]
+            label_i = output.max(1)[1] if (label_i is None) else label_i.unsqueeze(0)
+            return F.nll_loss(F.log_softmax(output, dim=1), label_i)
+
+        per_sample_grads = vmap(grad(negloglikelihood), in_dims=(None, 0, None if label is None else 0))(
+            params, x, label
+        )
+        return {n.replace('.', '__'): (g**2).sum(dim=0) for n, g in per_sample_grads.items()}
+
+    def _fisher_converged(self, est_fisher_info, n_samples, state):
+        '''Check whether running estimate of FI-matrix (i.e., summed squared gradients in [est_fisher_info] divided by
+        [n_samples]) has converged, by comparing after every [self.fisher_chunk] samples the relative change of its norm
+        with [self.fisher_tol]. The <dict> [state] keeps track of the norm at the previous check.'''
+        if (self.fisher_tol is None) or (n_samples - state.get('n_samples', 0) < self.fisher_chunk):
+            return False
+        values = est_fisher_info.values() if isinstance(est_fisher_info, dict) else [est_fisher_info]
+        norm = torch.sqrt(sum((v**2).sum() for v in values)).item() / n_samples
+        previous_norm = state.get('norm')
+        state.update(norm=norm, n_samples=n_samples)
+        return (previous_norm is not None) and (abs(norm-previous_norm) <= self.fisher_tol*previous_norm)
+
+    def _accumulate_fisher_batched(self, data_loader, est_fisher_info, n_total, allowed_classes=None):
+        '''Add squared per-sample gradients of samples from [data_loader] to [est_fisher_info] (<dict> with <tensor> per
+        parameter), computed for each batch at once. Returns the normalizer (the same as in the per-sample loop) and the
+        number of samples used.'''
+
+        modules = self._linear_modules()
+        n_samples = 0
+        converged = False
+        convergence_state = {}
+        for x, y in data_loader:
+            # only use up to [self.fisher_n] samples
+            if self.fisher_n is not None:
+                if n_samples >= self.fisher_n:
+                    break
+                x, y = x[:(self.fisher_n-n_samples)], y[:(self.fisher_n-n_samples)]
+            x = x.to(self._device())
+            # -use provided labels ("empirical Fisher") or predicted labels (if [label] is None)?
+            label = None
+            if self.emp_FI:
+                label = y if (allowed_classes is None) else torch.LongTensor(
+                    [allowed_classes.index(i) for i in y.tolist()]
+                )
+                label = label.to(self._device())
+            # -sum of squared per-sample gradients
+            if modules is not None:
+                squared_grads = self._squared_grads_closed_form(x, label, allowed_classes, modules)
+            else:
+                squared_grads = self._squared_grads_vmap(x, label, allowed_classes)
+            for n, squared_grad in squared_grads.items():
+                est_fisher_info[n] += squared_grad
+            n_samples += x.size(0)
+            # -if requested, stop once the estimate has converged
+            if self._fisher_converged(est_fisher_info, n_samples, convergence_state):
+                converged = True
+                break
+
+        # In the per-sample loop, the normalizer is the index of the sample at which it stopped
+        stopped_early = converged or ((self.fisher_n is not None) and (n_total > self.fisher_n))
+        return (n_samples if stopped_early else n_samples-1), n_samples
+
     def estimate_fisher(self, dataset, allowed_classes=None, collate_fn=None):
         '''After completing training on a task, estimate diagonal of Fisher Information matrix.
 
         [dataset]:          <DataSet> to be used to estimate FI-matrix
-        [allowed_classes]:  <list> with class-indeces of 'allowed' or 'active' classes'''
+        [allowed_classes]:  <list> with class-indeces of 'allowed' or 'active' classes
 
-        # Prepare <dict> to store estimated Fisher Information matrix
-        est_fisher_info = {}
-        for n, p in self.named_parameters():
-            if p.requires_grad:
-                n = n.replace('.', '__')
-                est_fisher_info[n] = p.detach().clone().zero_()
+        If [self.fisher_batch]>1, per-sample gradients are computed for batches of that size at once (in closed form if
+        all trainable parameters are in linear layers, otherwise with [torch.func] if it is available).
+        If [self.fisher_tol] is not None, estimation stops early once the estimate has converged.'''
+
+        # Prepare <dict> to store estimated Fisher Information matrix (or flat <tensor>, if using parameter arena)
+        flat = self.param_arena is not None
+        if flat:
+            est_fisher_info = torch.zeros_like(self.param_arena)
+        else:
+            est_fisher_info = {}
+            for n, p in self.named_parameters():
+                if p.requires_grad:
+                    n = n.replace('.', '__')
+                    est_fisher_info[n] = p.detach().clone().zero_()
 
         # Set model to evaluation mode
         mode = self.training
         self.eval()
 
-        # Create data-loader to give batches of size 1
-        data_loader = utils.get_data_loader(dataset, batch_size=1, cuda=self._is_on_cuda(), collate_fn=collate_fn)
+        # Compute per-sample gradients for a whole batch at once?
+        batched = (self.fisher_batch>1) and ((self._linear_modules() is not None) or (vmap is not None))
 
-        # Estimate the FI-matrix for [self.fisher_n] batches of size 1
-        for index,(x,y) in enumerate(data_loader):
-            # break from for-loop if max number of samples has been reached
-            if self.fisher_n is not None:
-                if index >= self.fisher_n:
-                    break
-            # run forward pass of model
-            x = x.to(self._device())
-            output = self(x) if allowed_classes is None else self(x)[:, allowed_classes]
-            if self.emp_FI:
-                # -use provided label to calculate loglikelihood --> "empirical Fisher":
-                label = torch.LongTensor([y]) if type(y)==int else y
-                if allowed_classes is not None:
-                    label = [int(np.where(i == allowed_classes)[0][0]) for i in label.numpy()]
-                    label = torch.LongTensor(label)
-                label = label.to(self._device())
-            else:
-                # -use predicted label to calculate loglikelihood:
-                label = output.max(1)[1]
-            # calculate negative log-likelihood
-            negloglikelihood = F.nll_loss(F.log_softmax(output, dim=1), label)
+        # Create data-loader to give batches of size 1 (or of size [self.fisher_batch])
+        data_loader = utils.get_data_loader(dataset, batch_size=self.fisher_batch if batched else 1,
+                                            cuda=self._is_on_cuda(), collate_fn=collate_fn)
 
-            # Calculate gradient of negative loglikelihood
-            self.zero_grad()
-            negloglikelihood.backward()
+        # If batched, estimate the FI-matrix from up to [self.fisher_n] samples with per-sample gradients
+        if batched:
+            # -if using parameter arena, accumulate in views (per parameter) into the flat tensor
+            trainable = [(n.replace('.', '__'), p) for n, p in self.named_parameters() if p.requires_grad]
+            fisher_per_param = est_fisher_info if not flat else {
+                n: f.view_as(p) for (n, p), f in zip(trainable, est_fisher_info.split(self.arena_sizes))
+            }
+            index, n_samples = self._accumulate_fisher_batched(data_loader, fisher_per_param, len(dataset),
+                                                               allowed_classes=allowed_classes)
 
-            # Square gradients and keep running sum
-            for n, p in self.named_parameters():
-                if p.requires_grad:
-                    n = n.replace('.', '__')
-                    if p.grad is not None:
-                        est_fisher_info[n] += p.grad.detach() ** 2
+        # Otherwise, estimate the FI-matrix for [self.fisher_n] batches of size 1
+        else:
+            n_samples = 0
+            converged = False
+            convergence_state = {}
+            for index,(x,y) in enumerate(data_loader):
+                # break from for-loop if max number of samples has been reached
+                if self.fisher_n is not None:
+                    if index >= self.fisher_n:
+                        break
+                # run forward pass of model
+                x = x.to(self._device())
+                output = self(x, classes=allowed_classes)
+                if self.emp_FI:
+                    # -use provided label to calculate loglikelihood --> "empirical Fisher":
+                    label = torch.LongTensor([y]) if type(y)==int else y
+                    if allowed_classes is not None:
+                        label = [int(np.where(i == allowed_classes)[0][0]) for i in label.numpy()]
+                        label = torch.LongTensor(label)
+                    label = label.to(self._device())
+                else:
+                    # -use predicted label to calculate loglikelihood:
+                    label = output.max(1)[1]
+                # calculate negative log-likelihood
+                negloglikelihood = F.nll_loss(F.log_softmax(output, dim=1), label)
+
+                # Calculate gradient of negative loglikelihood
+                if flat:
+                    self.zero_grad_arena()
+                else:
+                    self.zero_grad()
+                negloglikelihood.backward()
+
+                # Square gradients and keep running sum
+                if flat:
+                    est_fisher_info.addcmul_(self.grad_arena, self.grad_arena)
+                else:
+                    for n, p in self.named_parameters():
+                        if p.requires_grad:
+                            n = n.replace('.', '__')
+                            if p.grad is not None:
+                                est_fisher_info[n] += p.grad.detach() ** 2
+                n_samples += 1
+
+                # if requested, stop once the estimate has converged
+                if self._fisher_converged(est_fisher_info, n_samples, convergence_state):
+                    converged = True
+                    break
+            index = n_samples if converged else index
+
+        # Keep track of number of samples used
+        self.fisher_n_used.append(n_samples)
 
         # Normalize by sample size used for estimation
-        est_fisher_info = {n: p/index for n, p in est_fisher_info.items()}
+        if flat:
+            est_fisher_info /= index
+        else:
+            est_fisher_info = {n: p/index for n, p in est_fisher_info.items()}
+
+        # Should the new quadratic term be merged with the one of all previous tasks? (consolidated "offline EWC")
+        consolidate = self.consolidate_EWC and not self.online
+        if consolidate and (self.EWC_task_dir is not None):
+            mean = self.param_arena if flat else {
+                n.replace('.', '__'): p.detach() for n, p in self.named_parameters() if p.requires_grad
+            }
+            self._save_EWC_task_term(mean, est_fisher_info)
+        constant = getattr(self, 'EWC_constant', 0.) if (consolidate and self.EWC_task_count>0) else 0.
 
         # Store new values in the network
-        for n, p in self.named_parameters():
-            if p.requires_grad:
-                n = n.replace('.', '__')
-                # -mode (=MAP parameter estimate)
-                self.register_buffer('{}_EWC_prev_task{}'.format(n, "" if self.online else self.EWC_task_count+1),
-                                     p.detach().clone())
-                # -precision (approximated by diagonal Fisher Information matrix)
-                if self.online and self.EWC_task_count==1:
-                    existing_values = getattr(self, '{}_EWC_estimated_fisher'.format(n))
-                    est_fisher_info[n] += self.gamma * existing_values
-                self.register_buffer('{}_EWC_estimated_fisher{}'.format(n, "" if self.online else self.EWC_task_count+1),
-                                     est_fisher_info[n])
+        if flat:
+            constant = constant + self._store_EWC_flat(est_fisher_info, consolidate=consolidate)
+        else:
+            suffix = "" if (self.online or consolidate) else self.EWC_task_count+1
+            for n, p in self.named_parameters():
+                if p.requires_grad:
+                    n = n.replace('.', '__')
+                    # -mode (=MAP parameter estimate)
+                    mean = p.detach().clone()
+                    # -precision (approximated by diagonal Fisher Information matrix)
+                    if self.online and self.EWC_task_count==1:
+                        existing_values = self._get_importance('{}_EWC_estimated_fisher'.format(n), mean)
+                        est_fisher_info[n] += self.gamma * existing_values
+                    # -if consolidated "offline EWC", merge with quadratic term of previous tasks
+                    elif consolidate and self.EWC_task_count>0:
+                        mean, est_fisher_info[n], constant_add = self._merge_EWC_terms(
+                            getattr(self, '{}_EWC_prev_task'.format(n)),
+                            self._get_importance('{}_EWC_estimated_fisher'.format(n), mean), mean, est_fisher_info[n]
+                        )
+                        constant = constant + constant_add
+                    self.register_buffer('{}_EWC_prev_task{}'.format(n, suffix), mean)
+                    self._register_importance('{}_EWC_estimated_fisher{}'.format(n, suffix), est_fisher_info[n])
+        if consolidate:
+            self.register_buffer('EWC_constant', torch.as_tensor(constant, device=self._device()))
 
         # If "offline EWC", increase task-count (for "online EWC", set it to 1 to indicate EWC-loss can be calculated)
         self.EWC_task_count = 1 if self.online else self.EWC_task_count + 1
@@ -145,24 +533,51 @@ class ContinualLearner(nn.Module, metaclass=abc.ABCMeta):
         self.train(mode=mode)
 
 
+    def _store_EWC_flat(self, est_fisher_info, consolidate=False):
+        '''Store mode and precision (=[est_fisher_info]) of completed task in flat buffers matching the parameter arena.
+
+        Returns the constant to add to the EWC-loss (only non-zero if [consolidate]).'''
+        suffix = "" if (self.online or consolidate) else self.EWC_task_count+1
+        mean = self.param_arena.clone()
+        constant = 0.
+        if self.online and self.EWC_task_count==1:
+            est_fisher_info += self.gamma * self._get_importance('EWC_estimated_fisher', mean)
+        elif consolidate and self.EWC_task_count>0:
+            mean, est_fisher_info, constant = self._merge_EWC_terms(
+                self.EWC_prev_task, self._get_importance('EWC_estimated_fisher', mean), mean, est_fisher_info
+            )
+        self.register_buffer('EWC_prev_task{}'.format(suffix), mean)
+        self._register_importance('EWC_estimated_fisher{}'.format(suffix), est_fisher_info)
+        return constant
+
+
     def ewc_loss(self):
         '''Calculate EWC-loss.'''
-        if self.EWC_task_count>0:
+        # If consolidated "offline EWC", a constant needs to be added to the single quadratic term
+        constant = self.EWC_constant if (self.consolidate_EWC and not self.online and self.EWC_task_count>0) else 0.
+        if self.EWC_task_count>0 and (self.param_arena is not None):
+            losses = []
+            for suffix in self._EWC_terms():
+                mean = getattr(self, 'EWC_prev_task{}'.format(suffix))
+                fisher = getattr(self, 'EWC_estimated_fisher{}'.format(suffix))
+                fisher = self.gamma*fisher if self.online else fisher
+                losses.append(self._flat_penalty(mean, fisher))
+            return (1./2)*(sum(losses) + constant)
+        elif self.EWC_task_count>0:
             losses = []
-            # If "offline EWC", loop over all previous tasks (if "online EWC", [EWC_task_count]=1 so only 1 iteration)
-            for task in range(1, self.EWC_task_count+1):
+            # If "offline EWC", loop over all previous tasks (if "online EWC" or consolidated, only 1 iteration)
+            for suffix in self._EWC_terms():
                 for n, p in self.named_parameters():
                     if p.requires_grad:
                         # Retrieve stored mode (MAP estimate) and precision (Fisher Information matrix)
                         n = n.replace('.', '__')
-                        mean = getattr(self, '{}_EWC_prev_task{}'.format(n, "" if self.online else task))
-                        fisher = getattr(self, '{}_EWC_estimated_fisher{}'.format(n, "" if self.online else task))
-                        # If "online EWC", apply decay-term to the running sum of the Fisher Information matrices
-                        fisher = self.gamma*fisher if self.online else fisher
+                        mean = getattr(self, '{}_EWC_prev_task{}'.format(n, suffix))
                         # Calculate EWC-loss
-                        losses.append((fisher * (p-mean)**2).sum())
+                        loss = self._quadratic_penalty('{}_EWC_estimated_fisher{}'.format(n, suffix), p, mean)
+                        # If "online EWC", apply decay-term to the running sum of the Fisher Information matrices
+                        losses.append(self.gamma*loss if self.online else loss)
             # Sum EWC-loss from all parameters (and from all tasks, if "offline EWC")
-            return (1./2)*sum(losses)
+            return (1./2)*(sum(losses) + constant)
         else:
             # EWC-loss is 0 if there are no stored mode and precision yet
             return torch.tensor(0., device=self._device())
@@ -174,7 +589,18 @@ class ContinualLearner(nn.Module, metaclass=abc.ABCMeta):
         '''After completing training on a task, update the per-parameter regularization strength.
 
         [W]         <dict> estimated parameter-specific contribution to changes in total loss of completed task
-        [epsilon]   <float> dampening parameter (to bound [omega] when [p_change] goes to 0)'''
+        [epsilon]   <float> dampening parameter (to bound [omega] when [p_change] goes to 0)
+
+        If a parameter arena is used, [W] is a flat <tensor> (matching [self.param_arena]).'''
+
+        if self.param_arena is not None:
+            p_change = self.param_arena - self.SI_prev_task
+            omega_add = W/(p_change**2 + epsilon)
+            has_omega = getattr(self, 'SI_omega', None) is not None
+            omega = self._get_importance('SI_omega', omega_add) if has_omega else None
+            self.register_buffer('SI_prev_task', self.param_arena.clone())
+            self._register_importance('SI_omega', omega_add if (omega is None) else omega + omega_add)
+            return
 
         # Loop over all parameters
         for n, p in self.named_parameters():
@@ -187,18 +613,22 @@ class ContinualLearner(nn.Module, metaclass=abc.ABCMeta):
                 p_change = p_current - p_prev
                 omega_add = W[n]/(p_change**2 + epsilon)
                 try:
-                    omega = getattr(self, '{}_SI_omega'.format(n))
+                    omega = self._get_importance('{}_SI_omega'.format(n), p_current)
                 except AttributeError:
                     omega = p.detach().clone().zero_()
                 omega_new = omega + omega_add
 
                 # Store these new values in the model
                 self.register_buffer('{}_SI_prev_task'.format(n), p_current)
-                self.register_buffer('{}_SI_omega'.format(n), omega_new)
+                self._register_importance('{}_SI_omega'.format(n), omega_new)
 
 
     def surrogate_loss(self):
         '''Calculate SI's surrogate loss.'''
+        if self.param_arena is not None:
+            if getattr(self, 'SI_omega', None) is None:
+                return torch.tensor(0., device=self._device())
+            return self._flat_penalty(self.SI_prev_task, self.SI_omega)
         try:
             losses = []
             for n, p in self.named_parameters():
@@ -206,9 +636,8 @@ class ContinualLearner(nn.Module, metaclass=abc.ABCMeta):
                     # Retrieve previous parameter values and their normalized path integral (i.e., omega)
                     n = n.replace('.', '__')
                     prev_values = getattr(self, '{}_SI_prev_task'.format(n))
-                    omega = getattr(self, '{}_SI_omega'.format(n))
                     # Calculate SI's surrogate loss, sum over all parameters
-                    losses.append((omega * (p-prev_values)**2).sum())
+                    losses.append(self._quadratic_penalty('{}_SI_omega'.format(n), p, prev_values))
             return sum(losses)
         except AttributeError:
             # SI-loss is 0 if there is no stored omega yet
@@ -1,7 +1,9 @@
 import copy
+import os
+import hashlib
 import numpy as np
 from torchvision import datasets, transforms
-from torch.utils.data import ConcatDataset, Dataset
+from torch.utils.data import ConcatDataset, Dataset, Subset, Sampler
 import torch
 import pathlib
 import torchvision
@@ -12,22 +14,32 @@ from torchvision import transforms
 def _permutate_image_pixels(image, permutation):
     '''Permutate the pixels of an image according to [permutation].
 
-    [image]         3D-tensor containing the image
+    [image]         3D-tensor containing the image (or 4D-tensor containing a batch of images)
     [permutation]   <ndarray> of pixel-indeces in their new order'''
 
     if permutation is None:
         return image
     else:
-        c, h, w = image.size()
-        image = image.view(c, -1)
-        image = image[:, permutation]  #--> same permutation for each channel
-        image = image.view(c, h, w)
+        # -leading dimensions are kept, so this also works on a 4D-tensor containing a batch of images
+        image_shape = image.size()
+        image = image.view(*image_shape[:-2], -1)
+        image = image[..., permutation]  #--> same permutation for each channel
+        image = image.view(image_shape)
         return image
 
+
+def _is_batch_index(index):
+    '''Return whether [index] is a <list>/<ndarray>/<tensor> of indeces (rather than a single index).'''
+    return (not isinstance(index, (int, np.integer))) and np.ndim(index)>0
+
+
 #ablted flag to allow reading in of original images to all be used as test so no spliting into train and test needed
 def get_dataset(name, type='train',ablated=False, download=True, capacity=None, permutation=None, dir='./datasets',
-                verbose=False, target_transform=None):
-    '''Create [train|valid|test]-dataset.'''
+                verbose=False, target_transform=None, cache=False):
+    '''Create [train|valid|test]-dataset.
+
+    [cache]     <bool>; if True, dataset is decoded only once: MNIST/CIFAR10 are kept in memory as <uint8>-tensor (see
+                    <TensorCacheDataset>), image-folders are stored in a memory-mapped file (see <MemmapCacheDataset>)'''
 
     data_name = 'mnist' if name=='mnist28' else name
     if name not in ('animalpart'):
@@ -41,14 +53,20 @@ def get_dataset(name, type='train',ablated=False, download=True, capacity=None,
 
     # load data-set
     if name =="animalpart" and ablated==True:
-        dataset = torchvision.datasets.ImageFolder(f"/content/drive/My Drive/Data/{name}/",transform=dataset_transform, target_transform=target_transform)
+        dataset = _get_image_folder(name, dataset_transform, target_transform=target_transform, cache=cache, dir=dir,
+                                    permutation=permutation, verbose=verbose)
     
     elif name in ["animalpart","ablatedhead","ablatedtorso","ablatedtail","allanimalpart"] :
-        dataset = torchvision.datasets.ImageFolder(f"/content/drive/My Drive/Data/{name}/",transform=dataset_transform, target_transform=target_transform)
+        dataset = _get_image_folder(name, dataset_transform, target_transform=target_transform, cache=cache, dir=dir,
+                                    permutation=permutation, verbose=verbose)
         print(dataset)
         train_size = int(0.7 * len(dataset))
         test_size = len(dataset) - train_size
         train_dataset, test_dataset = torch.utils.data.random_split(dataset, [train_size, test_size])
+        if cache:
+            # -store split-indeces as <ndarray>, so that the memory-mapped dataset can still be indexed per batch
+            train_dataset = Subset(dataset, np.asarray(train_dataset.indices, dtype=np.int64))
+            test_dataset = Subset(dataset, np.asarray(test_dataset.indices, dtype=np.int64))
         if type == 'test':
             dataset = test_dataset
         else:
@@ -56,7 +74,8 @@ def get_dataset(name, type='train',ablated=False, download=True, capacity=None,
     else:   
         dataset = dataset_class('{dir}/{name}'.format(dir=dir, name=data_name), train=False if type=='test' else True,
                             download=download, transform=dataset_transform, target_transform=target_transform)
-        
+        if cache:
+            dataset = TensorCacheDataset(dataset)
 
     # print information about dataset on the screen
     if verbose:
@@ -70,6 +89,31 @@ def get_dataset(name, type='train',ablated=False, download=True, capacity=None,
     return dataset
 
 
+def _get_image_folder(name, dataset_transform, target_transform=None, cache=False, dir='./datasets', permutation=None,
+                      verbose=False):
+    '''Return image-folder dataset [name], if requested read from a (possibly newly created) memory-mapped file.
+
+    The memory-mapped file is keyed by [name] and by the image-transformations that are applied.'''
+
+    root = f"/content/drive/My Drive/Data/{name}/"
+    if not cache:
+        return torchvision.datasets.ImageFolder(root, transform=dataset_transform, target_transform=target_transform)
+
+    # -find path of memory-mapped file for this dataset & transform
+    transform_key = repr(AVAILABLE_TRANSFORMS[name]) + ("" if permutation is None else str(list(permutation)))
+    path = '{dir}/cache/{name}-{key}'.format(dir=dir, name=name,
+                                             key=hashlib.md5(transform_key.encode()).hexdigest()[:10])
+
+    # -if it does not exist yet, preprocess all images once and write them to the memory-mapped file
+    if not os.path.isfile(path + '.npy'):
+        if verbose:
+            print(" --> {}: preprocessing images into '{}.npy'".format(name, path))
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        MemmapCacheDataset.create(torchvision.datasets.ImageFolder(root, transform=dataset_transform), path)
+
+    return MemmapCacheDataset(path, target_transform=target_transform)
+
+
 #----------------------------------------------------------------------------------------------------------#
 
 
@@ -82,24 +126,25 @@ class SubDataset(Dataset):
     def __init__(self, original_dataset, sub_labels, target_transform=None):
         super().__init__()
         self.dataset = original_dataset
-        self.sub_indeces = []
-        for index in range(len(self.dataset)):
-            if hasattr(original_dataset, "targets"):
-                if self.dataset.target_transform is None:
-                    label = self.dataset.targets[index]
-                else:
-                    label = self.dataset.target_transform(self.dataset.targets[index])
-            else:
-                label = self.dataset[index][1]
-            if label in sub_labels:
-                self.sub_indeces.append(index)
+        # -look up indeces of all samples with label in [sub_labels] (class-index is shared across sub-datasets)
+        class_index = get_class_index(self.dataset)
+        indeces_per_label = [class_index[label] for label in sub_labels if label in class_index]
+        self.sub_indeces = np.sort(np.concatenate(indeces_per_label)) if len(indeces_per_label)>0 else np.array(
+            [], dtype=np.int64
+        )
         self.target_transform = target_transform
 
     def __len__(self):
         return len(self.sub_indeces)
 
     def __getitem__(self, index):
-        sample = self.dataset[self.sub_indeces[index]]
+        if _is_batch_index(index):
+            # -[index] is a <list>/<tensor> of indeces, so return whole batch (only if supported by [self.dataset])
+            (input, target) = self.dataset[self.sub_indeces[np.asarray(index)]]
+            if self.target_transform:
+                target = torch.from_numpy(_apply_target_transform(target.numpy(), self.target_transform))
+            return (input, target)
+        sample = self.dataset[int(self.sub_indeces[index])]
         if self.target_transform:
             target = self.target_transform(sample[1])
             sample = (sample[0], target)
@@ -109,35 +154,61 @@ class SubDataset(Dataset):
 class ExemplarDataset(Dataset):
     '''Create dataset from list of <np.arrays> with shape (N, C, H, W) (i.e., with N images each).
 
-    The images at the i-th entry of [exemplar_sets] belong to class [i], unless a [target_transform] is specified'''
+    The images at the i-th entry of [exemplar_sets] belong to class [i], unless a [target_transform] is specified.
+    All exemplars are stored in one contiguous tensor (with [class_offsets] indicating where each class starts, so that
+    the exemplars of class [i] are [inputs][class_offsets[i]:class_offsets[i+1]]), and the [target_transform] is applied
+    once to all labels, so that batches can be collected by a single index gather. Empty exemplar-sets (e.g., with shape
+    (0,) if the memory budget per class is zero) are allowed.'''
 
     def __init__(self, exemplar_sets, target_transform=None):
         super().__init__()
-        self.exemplar_sets = exemplar_sets
-        self.target_transform = target_transform
+        exemplars_per_class = [len(exemplar_set) for exemplar_set in exemplar_sets]
+        self.class_offsets = np.concatenate([[0], np.cumsum(exemplars_per_class)]).astype(np.int64)
+        non_empty_sets = [exemplar_set for exemplar_set in exemplar_sets if len(exemplar_set)>0]
+        self.inputs = torch.from_numpy(np.concatenate(non_empty_sets)) if len(non_empty_sets)>0 else torch.empty(0)
+        class_ids = np.repeat(np.arange(len(exemplar_sets), dtype=np.int64), exemplars_per_class)
+        self.targets = torch.from_numpy(_apply_target_transform(class_ids, target_transform).astype(np.int64))
 
     def __len__(self):
-        total = 0
-        for class_id in range(len(self.exemplar_sets)):
-            total += len(self.exemplar_sets[class_id])
-        return total
+        return len(self.targets)
 
     def __getitem__(self, index):
-        total = 0
-        for class_id in range(len(self.exemplar_sets)):
-            exemplars_in_this_class = len(self.exemplar_sets[class_id])
-            if index < (total + exemplars_in_this_class):
-                class_id_to_return = class_id if self.target_transform is None else self.target_transform(class_id)
-                exemplar_id = index - total
-                break
-            else:
-                total += exemplars_in_this_class
-        image = torch.from_numpy(self.exemplar_sets[class_id][exemplar_id])
-        return (image, class_id_to_return)
+        if not _is_batch_index(index):
+            return (self.inputs[int(index)], int(self.targets[index]))
+        index = torch.as_tensor(index, dtype=torch.long)
+        return (self.inputs[index], self.targets[index])
+
+
+class ConcatBatchDataset(Dataset):
+    '''Concatenation of [datasets] that all return whole batches when indexed with a <list>/<tensor> of indeces (see
+    [supports_batch_indexing]), so that a batch of indeces into this dataset is also returned as a whole batch.
+
+    The indeces of a batch are split per dataset (keeping their order within each dataset) and the sub-batches are
+    concatenated in order of the datasets (as in the batches of <InfiniteStratifiedBatchSampler>).'''
+
+    def __init__(self, datasets):
+        super().__init__()
+        self.datasets = list(datasets)
+        self.offsets = np.cumsum([0] + [len(dataset) for dataset in self.datasets]).astype(np.int64)
+
+    def __len__(self):
+        return int(self.offsets[-1])
+
+    def __getitem__(self, index):
+        if not _is_batch_index(index):
+            dataset_id = int(np.searchsorted(self.offsets, index, side='right'))-1
+            return self.datasets[dataset_id][int(index)-int(self.offsets[dataset_id])]
+        index = np.asarray(index, dtype=np.int64)
+        dataset_ids = np.searchsorted(self.offsets, index, side='right')-1
+        batches = [self.datasets[dataset_id][index[dataset_ids==dataset_id]-self.offsets[dataset_id]]
+                   for dataset_id in np.unique(dataset_ids)]
+        return tuple(torch.cat([torch.as_tensor(part) for part in parts]) for parts in zip(*batches))
 
 
 class TransformedDataset(Dataset):
-    '''Modify existing dataset with transform; for creating multiple MNIST-permutations w/o loading data every time.'''
+    '''Modify existing dataset with transform; for creating multiple MNIST-permutations w/o loading data every time.
+
+    If [original_dataset] returns whole batches (see [supports_batch_indexing]), [transform] is applied to the batch.'''
 
     def __init__(self, original_dataset, transform=None, target_transform=None):
         super().__init__()
@@ -153,10 +224,247 @@ class TransformedDataset(Dataset):
         if self.transform:
             input = self.transform(input)
         if self.target_transform:
-            target = self.target_transform(target)
+            if _is_batch_index(index):
+                target = torch.from_numpy(_apply_target_transform(target.numpy(), self.target_transform))
+            else:
+                target = self.target_transform(target)
         return (input, target)
 
 
+class ScoredDataset(Dataset):
+    '''Dataset that returns for each sample of [original_dataset] also its [scores] (e.g., logits predicted by a model).
+
+    [scores] should be a <tensor> with a row for each sample (in the same order as [original_dataset]). Samples are
+    returned as tuple ([input], [target], [scores]); if [original_dataset] returns whole batches, so does this one.'''
+
+    def __init__(self, original_dataset, scores):
+        super().__init__()
+        self.dataset = original_dataset
+        self.scores = scores
+
+    def __len__(self):
+        return len(self.dataset)
+
+    def __getitem__(self, index):
+        (input, target) = self.dataset[index]
+        scores = self.scores[torch.as_tensor(index, dtype=torch.long)] if _is_batch_index(index) else self.scores[index]
+        return (input, target, scores)
+
+
+class PermutedDataset(Dataset):
+    '''Dataset with the pixels of all images in [original_dataset] permuted according to row [task_id] of [permutations].
+
+    All tasks of permMNIST share the same [original_dataset] and the same <int16>-tensor [permutations] (tasks x pixels).
+    Data-loaders (see [utils.get_data_loader]) load the un-permuted samples from [self.unpermuted] and then permute the
+    pixels of each collated batch with a single gather (see [permute_batch]).'''
+
+    def __init__(self, original_dataset, permutations, task_id, target_transform=None):
+        super().__init__()
+        self.permutations = permutations
+        self.task_id = task_id
+        permutation = permutations[task_id].long()
+        # -if this task's permutation is the identity, pixels do not need to be permuted at all
+        self.permutation = None if torch.equal(permutation, torch.arange(len(permutation))) else permutation
+        self.unpermuted = TransformedDataset(original_dataset, target_transform=target_transform)
+
+    def __len__(self):
+        return len(self.unpermuted)
+
+    def __getitem__(self, index):
+        (input, target) = self.unpermuted[index]
+        return (_permutate_image_pixels(input, self.permutation), target)
+
+    def permute_batch(self, batch):
+        '''Permute the pixels of all images in the collated [batch] (= tuple ([x], [y])) at once.'''
+        (x, y) = batch
+        return (_permutate_image_pixels(x, self.permutation), y)
+
+
+class TensorCacheDataset(Dataset):
+    '''Decode [original_dataset] once into a contiguous <uint8>-tensor with all inputs and a tensor with all labels.
+
+    The inputs of [original_dataset] should have values k/255 (as returned by [transforms.ToTensor]), so that they can
+    be stored without loss. Conversion to float is only done when samples are served. Indexing with a <list>/<tensor>
+    of indeces returns a whole batch by a single gather (this is used by [utils.get_data_loader]).'''
+
+    def __init__(self, original_dataset):
+        super().__init__()
+        self.targets = torch.from_numpy(np.asarray(get_targets(original_dataset), dtype=np.int64))
+        input_size = original_dataset[0][0].size()
+        self.inputs = torch.empty((len(original_dataset), *input_size), dtype=torch.uint8)
+        for index in range(len(original_dataset)):
+            self.inputs[index] = original_dataset[index][0].mul(255).round_()
+
+    def __len__(self):
+        return self.inputs.size(0)
+
+    def __getitem__(self, index):
+        if not _is_batch_index(index):
+            return (self.inputs[int(index)].float().div_(255), int(self.targets[index]))
+        index = torch.as_tensor(index, dtype=torch.long)
+        return (self.inputs[index].float().div_(255), self.targets[index])
+
+
+class MemmapCacheDataset(Dataset):
+    '''Dataset that reads preprocessed inputs from a memory-mapped <uint8>-array (N, C, H, W) stored at [path].npy.
+
+    The array (and a sidecar-file [path]-labels.npy with the labels) is written once by [MemmapCacheDataset.create].
+    Samples are read as slices from the memory-map, so repeated runs (and parallel processes) share the page cache.
+    Indexing with a <list>/<tensor> of indeces returns a whole batch (this is used by [utils.get_data_loader]).'''
+
+    def __init__(self, path, target_transform=None):
+        super().__init__()
+        self.path = path
+        self.inputs = np.load(path + '.npy', mmap_mode='c')  #--> copy-on-write, so arrays are writable for torch
+        self.targets = np.load(path + '-labels.npy')
+        self.target_transform = target_transform
+
+    @staticmethod
+    def create(original_dataset, path):
+        '''Decode all samples of [original_dataset] once and write them to [path].npy (and labels to [path]-labels.npy).
+
+        Inputs should have values k/255 (as returned by [transforms.ToTensor]), so they can be stored as <uint8>.'''
+        input_size = tuple(original_dataset[0][0].size())
+        tmp_path = '{}-{}.tmp'.format(path, os.getpid())
+        inputs = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=np.uint8,
+                                           shape=(len(original_dataset),) + input_size)
+        for index in range(len(original_dataset)):
+            inputs[index] = original_dataset[index][0].mul(255).round_().to(torch.uint8).numpy()
+        inputs.flush()
+        del inputs
+        np.save(path + '-labels.npy', np.asarray(original_dataset.targets, dtype=np.int64))
+        # -only make the file available once it is complete (other processes might be waiting for it)
+        os.replace(tmp_path, path + '.npy')
+
+    def __len__(self):
+        return len(self.inputs)
+
+    def __getitem__(self, index):
+        if not _is_batch_index(index):
+            target = int(self.targets[index])
+            target = self.target_transform(target) if self.target_transform else target
+            return (torch.from_numpy(self.inputs[int(index)]).float().div_(255), target)
+        index = np.asarray(index, dtype=np.int64)
+        target = _apply_target_transform(self.targets[index], self.target_transform)
+        return (torch.from_numpy(self.inputs[index]).float().div_(255), torch.from_numpy(target))
+
+    def __repr__(self):
+        return self.__class__.__name__ + '(path=' + self.path + ', samples=' + str(len(self)) + ')'
+
+
+#----------------------------------------------------------------------------------------------------------#
+
+
+def _apply_target_transform(labels, target_transform=None):
+    '''Apply [target_transform] to <ndarray> [labels], calling it only once for each unique label.'''
+    if target_transform is None or len(labels)==0:
+        return labels
+    unique_labels, inverse = np.unique(labels, return_inverse=True)
+    transformed_labels = np.array([target_transform(int(label)) for label in unique_labels])
+    return transformed_labels[inverse]
+
+
+def get_targets(dataset):
+    '''Return <ndarray> with the (transformed) label of every sample in [dataset], without loading any inputs.
+
+    Labels are read from the [targets]-attribute of the base dataset and propagated through <Subset>-, <ConcatDataset>-,
+    <ConcatBatchDataset>-, <TransformedDataset>-, <PermutedDataset>-, <ScoredDataset>- and <SubDataset>-objects. Only if
+    no such meta-data is available, [dataset] is iterated over.'''
+
+    if getattr(dataset, "_cached_targets", None) is not None:
+        return dataset._cached_targets
+
+    if isinstance(dataset, SubDataset):
+        labels = _apply_target_transform(get_targets(dataset.dataset)[dataset.sub_indeces], dataset.target_transform)
+    elif isinstance(dataset, TransformedDataset):
+        labels = _apply_target_transform(get_targets(dataset.dataset), dataset.target_transform)
+    elif isinstance(dataset, ScoredDataset):
+        labels = get_targets(dataset.dataset)
+    elif isinstance(dataset, PermutedDataset):
+        labels = get_targets(dataset.unpermuted)
+    elif isinstance(dataset, ExemplarDataset):
+        labels = dataset.targets.numpy()
+    elif isinstance(dataset, Subset):
+        labels = get_targets(dataset.dataset)[np.asarray(dataset.indices, dtype=np.int64)]
+    elif isinstance(dataset, (ConcatDataset, ConcatBatchDataset)):
+        labels = np.concatenate([get_targets(sub_dataset) for sub_dataset in dataset.datasets])
+    elif hasattr(dataset, "targets"):
+        labels = _apply_target_transform(np.asarray(dataset.targets), getattr(dataset, "target_transform", None))
+    else:
+        # -no label meta-data available, so loop over all samples (and do not cache result)
+        return np.array([dataset[index][1] for index in range(len(dataset))])
+
+    # -cache labels on the dataset, so they are only collected once
+    dataset._cached_targets = labels
+    return labels
+
+
+def supports_batch_indexing(dataset):
+    '''Return whether [dataset] returns a whole batch when indexed with a <list>/<tensor> of indeces.'''
+    if isinstance(dataset, (TensorCacheDataset, MemmapCacheDataset, ExemplarDataset)):
+        return True
+    elif isinstance(dataset, (SubDataset, TransformedDataset, ScoredDataset)):
+        return supports_batch_indexing(dataset.dataset)
+    elif isinstance(dataset, Subset) and isinstance(dataset.indices, np.ndarray):
+        return supports_batch_indexing(dataset.dataset)
+    elif isinstance(dataset, PermutedDataset):
+        return supports_batch_indexing(dataset.unpermuted)
+    elif isinstance(dataset, ConcatBatchDataset):
+        return all(supports_batch_indexing(sub_dataset) for sub_dataset in dataset.datasets)
+    return False
+
+
+class InfiniteBatchSampler(Sampler):
+    '''Sampler that endlessly yields batches of [batch_size] random indeces into a dataset with [n_samples] samples.
+
+    Samples are drawn without replacement until all of them have been used, after which a new random order is drawn
+    without interrupting the iteration (samples that do not fill a complete batch at the end of an epoch are skipped).'''
+
+    def __init__(self, n_samples, batch_size):
+        if not 0 < batch_size <= n_samples:
+            raise ValueError("Batch-size should be in [1, {}], but is {}.".format(n_samples, batch_size))
+        self.n_samples = n_samples
+        self.batch_size = batch_size
+
+    def __iter__(self):
+        while True:
+            order = torch.randperm(self.n_samples)
+            for start in range(0, self.n_samples-self.batch_size+1, self.batch_size):
+                yield order[start:(start+self.batch_size)].tolist()
+
+
+class InfiniteStratifiedBatchSampler(Sampler):
+    '''Sampler that endlessly yields batches of random indeces into a <ConcatDataset> of datasets with [n_samples]
+    samples, with each batch consisting of [batch_sizes][i] samples from the i-th dataset (ordered per dataset).
+
+    For each dataset, samples are drawn as with <InfiniteBatchSampler>.'''
+
+    def __init__(self, n_samples, batch_sizes):
+        if not len(n_samples)==len(batch_sizes):
+            raise ValueError("A batch-size should be specified for each of the {} datasets.".format(len(n_samples)))
+        self.samplers = [InfiniteBatchSampler(n, batch_size) for n, batch_size in zip(n_samples, batch_sizes)]
+        self.offsets = np.cumsum([0] + list(n_samples[:-1])).tolist()
+
+    def __iter__(self):
+        iterators = [iter(sampler) for sampler in self.samplers]
+        while True:
+            yield [offset+index for iterator, offset in zip(iterators, self.offsets) for index in next(iterator)]
+
+
+def get_class_index(dataset):
+    '''Return <dict> mapping each label in [dataset] to an <ndarray> with the indeces of all samples with that label.
+
+    The index is built with a single vectorized pass over the labels, and is cached on [dataset] so that it can be
+    shared by all <SubDataset>-objects created from it.'''
+
+    if getattr(dataset, "_class_index", None) is None:
+        labels = get_targets(dataset)
+        order = np.argsort(labels, kind='stable')
+        unique_labels, first_positions = np.unique(labels[order], return_index=True)
+        dataset._class_index = dict(zip(unique_labels.tolist(), np.split(order, first_positions[1:])))
+    return dataset._class_index
+
+
 #----------------------------------------------------------------------------------------------------------#
 
 
@@ -219,11 +527,13 @@ DATASET_CONFIGS = {
 
 
 def get_multitask_experiment(name, scenario, tasks, data_dir="./datasets", only_config=False, verbose=False,
-                             exception=False):
+                             exception=False, cache_data=False):
     '''Load, organize and return train- and test-dataset for requested experiment.
 
     [exception]:    <bool>; if True, for visualization no permutation is applied to first task (permMNIST) or digits
-                            are not shuffled before being distributed over the tasks (splitMNIST)'''
+                            are not shuffled before being distributed over the tasks (splitMNIST)
+    [cache_data]:   <bool>; if True, datasets are decoded only once (MNIST/CIFAR10 are kept in memory as <uint8>-tensors,
+                            image-folders are preprocessed into memory-mapped files in [data_dir]/cache)'''
 
     # depending on experiment, get and organize the datasets
     if name == 'permMNIST':
@@ -233,28 +543,30 @@ def get_multitask_experiment(name, scenario, tasks, data_dir="./datasets", only_
         if not only_config:
             # prepare dataset
             train_dataset = get_dataset('mnist', type="train", permutation=None, dir=data_dir,
-                                        target_transform=None, verbose=verbose)
+                                        target_transform=None, verbose=verbose, cache=cache_data)
             test_dataset = get_dataset('mnist', type="test", permutation=None, dir=data_dir,
-                                       target_transform=None, verbose=verbose)
+                                       target_transform=None, verbose=verbose, cache=cache_data)
             # generate permutations
             if exception:
                 permutations = [None] + [np.random.permutation(config['size']**2) for _ in range(tasks-1)]
             else:
                 permutations = [np.random.permutation(config['size']**2) for _ in range(tasks)]
+            # -store them as one <int16>-table (tasks x pixels), shared by all tasks (no permutation = identity)
+            permutations = torch.from_numpy(np.stack([
+                np.arange(config['size']**2) if perm is None else perm for perm in permutations
+            ]).astype(np.int16))
             # prepare datasets per task
             train_datasets = []
             test_datasets = []
-            for task_id, perm in enumerate(permutations):
+            for task_id in range(tasks):
                 target_transform = transforms.Lambda(
                     lambda y, x=task_id: y + x*classes_per_task
                 ) if scenario in ('task', 'class') else None
-                train_datasets.append(TransformedDataset(
-                    train_dataset, transform=transforms.Lambda(lambda x, p=perm: _permutate_image_pixels(x, p)),
-                    target_transform=target_transform
+                train_datasets.append(PermutedDataset(
+                    train_dataset, permutations=permutations, task_id=task_id, target_transform=target_transform
                 ))
-                test_datasets.append(TransformedDataset(
-                    test_dataset, transform=transforms.Lambda(lambda x, p=perm: _permutate_image_pixels(x, p)),
-                    target_transform=target_transform
+                test_datasets.append(PermutedDataset(
+                    test_dataset, permutations=permutations, task_id=task_id, target_transform=target_transform
                 ))
                 
     elif name == 'splitMNIST':
@@ -270,9 +582,9 @@ def get_multitask_experiment(name, scenario, tasks, data_dir="./datasets", only_
             target_transform = transforms.Lambda(lambda y, p=permutation: int(p[y]))
             # prepare train and test datasets with all classes
             mnist_train = get_dataset('mnist28', type="train", dir=data_dir, target_transform=target_transform,
-                                      verbose=verbose)
+                                      verbose=verbose, cache=cache_data)
             mnist_test = get_dataset('mnist28', type="test", dir=data_dir, target_transform=target_transform,
-                                     verbose=verbose)
+                                     verbose=verbose, cache=cache_data)
             # generate labels-per-task
             labels_per_task = [
                 list(np.array(range(classes_per_task)) + classes_per_task * task_id) for task_id in range(tasks)
@@ -301,9 +613,9 @@ def get_multitask_experiment(name, scenario, tasks, data_dir="./datasets", only_
             target_transform = transforms.Lambda(lambda y, p=permutation: int(p[y]))
             # prepare train and test datasets with all classes
             cifar10_train = get_dataset('cifar10', type="train", dir=data_dir, target_transform=target_transform,
-                                      verbose=verbose)
+                                      verbose=verbose, cache=cache_data)
             cifar10_test = get_dataset('cifar10', type="test", dir=data_dir, target_transform=target_transform,
-                                     verbose=verbose)
+                                     verbose=verbose, cache=cache_data)
             # generate labels-per-task
             labels_per_task = [
                 list(np.array(range(classes_per_task)) + classes_per_task * task_id) for task_id in range(tasks)
@@ -335,9 +647,9 @@ def get_multitask_experiment(name, scenario, tasks, data_dir="./datasets", only_
             
             # prepare train and test datasets with all classes
             animalpart_train = get_dataset('animalpart', type="train", dir=data_dir, target_transform=target_transform,
-                                      verbose=verbose)
+                                      verbose=verbose, cache=cache_data)
             animalpart_test = get_dataset('animalpart', type="test", dir=data_dir, target_transform=target_transform,
-                                     verbose=verbose)
+                                     verbose=verbose, cache=cache_data)
             
             # generate labels-per-task
             labels_per_task = [
@@ -376,26 +688,26 @@ def get_multitask_experiment(name, scenario, tasks, data_dir="./datasets", only_
             
             # prepare original images for test datasets with all classes
             animalpart_test = get_dataset('animalpart', type="test", ablated=True , dir=data_dir, target_transform=target_transform,
-                                     verbose=verbose)
+                                     verbose=verbose, cache=cache_data)
             #for Ablated head
             if name=="ABLATEDHEAD":
                 ablated_train = get_dataset('ablatedhead', type="train", dir=data_dir, target_transform=target_transform,
-                                      verbose=verbose)
+                                      verbose=verbose, cache=cache_data)
                 ablated_test = get_dataset('ablatedhead', type="test", dir=data_dir, target_transform=target_transform,
-                                         verbose=verbose)
+                                         verbose=verbose, cache=cache_data)
             #for Ablated torso
             if name=="ABLATEDTORSO":
                 ablated_train = get_dataset('ablatedtorso', type="train", dir=data_dir, target_transform=target_transform,
-                                      verbose=verbose)
+                                      verbose=verbose, cache=cache_data)
                 ablated_test = get_dataset('ablatedtorso', type="test", dir=data_dir, target_transform=target_transform,
-                                         verbose=verbose)
+                                         verbose=verbose, cache=cache_data)
                 
             #for Ablated tail
             if name=="ABLATEDTAIL":
                 ablated_train = get_dataset('ablatedtail', type="train", dir=data_dir, target_transform=target_transform,
-                                      verbose=verbose)
+                                      verbose=verbose, cache=cache_data)
                 ablated_test = get_dataset('ablatedtail', type="test", dir=data_dir, target_transform=target_transform,
-                                         verbose=verbose)
+                                         verbose=verbose, cache=cache_data)
             
             # generate labels-per-task
             labels_per_task = [
@@ -433,22 +745,22 @@ def get_multitask_experiment(name, scenario, tasks, data_dir="./datasets", only_
             #target_transform = transforms.Lambda(lambda y, p=permutation: int(p[y]))
             
             # prepare train and test datasets with all classes          #REMOVED: target_transform=target_transform
-            animalpart_test = get_dataset('animalpart', type="test",ablated=True, dir=data_dir,verbose=verbose)
+            animalpart_test = get_dataset('animalpart', type="test",ablated=True, dir=data_dir,verbose=verbose, cache=cache_data)
             
             ablatedhead_train = get_dataset('ablatedhead', type="train", dir=data_dir,
-                                      verbose=verbose)
+                                      verbose=verbose, cache=cache_data)
             ablatedhead_test = get_dataset('ablatedhead', type="test", dir=data_dir,
-                                         verbose=verbose)
+                                         verbose=verbose, cache=cache_data)
      
             ablatedtorso_train = get_dataset('ablatedtorso', type="train", dir=data_dir,
-                                      verbose=verbose)
+                                      verbose=verbose, cache=cache_data)
             ablatedtorso_test = get_dataset('ablatedtorso', type="test", dir=data_dir,
-                                         verbose=verbose)
+                                         verbose=verbose, cache=cache_data)
                 
             ablatedtail_train = get_dataset('ablatedtail', type="train", dir=data_dir,
-                                      verbose=verbose)
+                                      verbose=verbose, cache=cache_data)
             ablatedtail_test = get_dataset('ablatedtail', type="test", dir=data_dir,
-                                         verbose=verbose)
+                                         verbose=verbose, cache=cache_data)
            
             
             # arrange them up into perutation tasks eg. [ablated head,ablated torso,ablated tail]
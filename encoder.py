@@ -1,3 +1,4 @@
+import functools
 import torch
 from torch.nn import functional as F
 from linear_nets import MLP,fc_layer
@@ -26,6 +27,8 @@ class Classifier(ContinualLearner, Replayer, ExemplarHandler):
                                                  #   predicted probs as binary targets (only in Class-IL with binaryCE)
         self.AGEM = AGEM  #-> use gradient of replayed data as inequality constraint for (instead of adding it to)
                           #   the gradient of the current data (as in A-GEM, see Chaudry et al., 2019; ICLR)
+        self.fuse_replay = False #-> if possible, run current and replayed data through the model in one forward pass
+                                 #   (NOTE: with batch-norm, statistics are then computed over this combined batch)
 
         # check whether there is at least 1 fc-layer
         if fc_layers<1:
@@ -59,15 +62,22 @@ class Classifier(ContinualLearner, Replayer, ExemplarHandler):
         return "{}_c{}".format(self.fcE.name, self.classes)
 
 
-    def forward(self, x):
-        final_features = self.fcE(self.flatten(x))
-        return self.classifier(final_features)
+    def forward(self, x, task_ids=None, classes=None):
+        '''If [task_ids] (<tensor>, starting from 1) is provided, each sample in [x] gets the mask of its task.
+        If [classes] (<list>) is provided, only the logits of these classes are returned (and if they are contiguous,
+        only these are computed).'''
+        final_features = self.fcE(self.flatten(x), task_ids=task_ids)
+        selection = None if (classes is None) else utils.class_slice(classes)
+        if selection is not None:
+            return self.classifier(final_features, out_slice=selection)
+        return utils.select_classes(self.classifier(final_features), classes)
 
     def feature_extractor(self, images):
         return self.fcE(self.flatten(images))
 
 
-    def train_a_batch(self, x, y, scores=None, x_=None, y_=None, scores_=None, rnt=0.5, active_classes=None, task=1):
+    def train_a_batch(self, x, y, scores=None, x_=None, y_=None, scores_=None, rnt=0.5, active_classes=None, task=1,
+                      task_ids_=None):
         '''Train model for one batch ([x],[y]), possibly supplemented with replayed data ([x_],[y_/scores_]).
 
         [x]               <tensor> batch of inputs (could be None, in which case only 'replayed' data is used)
@@ -79,16 +89,28 @@ class Classifier(ContinualLearner, Replayer, ExemplarHandler):
         [scores_]         None or (<list> of) <tensor> 2Dtensor:[batch]x[classes] predicted "scores"/"logits" for [x_]
         [rnt]             <number> in [0,1], relative importance of new task
         [active_classes]  None or (<list> of) <list> with "active" classes
-        [task]            <int>, for setting task-specific mask'''
+        [task]            <int>, for setting task-specific mask
+        [task_ids_]       None or <tensor> with for each sample in [x_] the task (starting from 0) according to which
+                            it should be evaluated (Task-IL scenario with replay of all tasks in single batch)'''
 
         # Set model to training-mode
         self.train()
 
         # Reset optimizer
-        self.optimizer.zero_grad()
+        if self.param_arena is not None:
+            self.zero_grad_arena()
+        else:
+            self.optimizer.zero_grad()
 
-        # Should gradient be computed separately for each task? (needed when a task-mask is combined with replay)
-        gradient_per_task = True if ((self.mask_dict is not None) and (x_ is not None)) else False
+        # Should current and replayed data be run through the model in a single forward pass? (only possible if there
+        # is no task-mask, if [x_] is not a list with separate replay per task and if not using A-GEM)
+        fused_forward = self.fuse_replay and (x is not None) and (x_ is not None) and (not type(x_)==list) and (
+            self.mask_dict is None
+        ) and (not self.AGEM)
+        if fused_forward:
+            # -with 'current' replay (e.g., LwF), [x_] is [x] so it only needs to be run once
+            y_hat_fused = self(x) if (x_ is x) else self(torch.cat([x, x_]))
+            y_hat_fused_ = y_hat_fused if (x_ is x) else y_hat_fused[x.size(0):]
 
 
         ##--(1)-- REPLAYED DATA --##
@@ -96,34 +118,75 @@ class Classifier(ContinualLearner, Replayer, ExemplarHandler):
         if x_ is not None:
             # In the Task-IL scenario, [y_] or [scores_] is a list and [x_] needs to be evaluated on each of them
             # (in case of 'exact' or 'exemplar' replay, [x_] is also a list!
+            # (except if [task_ids_] is provided, then for each sample in [x_] only the classes of its task are used)
             TaskIL = (type(y_)==list) if (y_ is not None) else (type(scores_)==list)
             if not TaskIL:
                 y_ = [y_]
                 scores_ = [scores_]
-                active_classes = [active_classes] if (active_classes is not None) else None
+                if task_ids_ is None:
+                    active_classes = [active_classes] if (active_classes is not None) else None
             n_replays = len(y_) if (y_ is not None) else len(scores_)
 
+            # If [task_ids_] is provided, find for each replayed sample its active classes and the weight with which
+            # it should contribute to the replay loss (so that the loss of each task is averaged over its samples)
+            if task_ids_ is not None:
+                class_entries_ = torch.tensor(active_classes, device=task_ids_.device)[task_ids_]
+                samples_per_task = torch.bincount(task_ids_)
+                weights_ = 1. / (samples_per_task[task_ids_] * (samples_per_task>0).sum()).float()
+            else:
+                weights_ = None
+
             # Prepare lists to store losses for each replay
             loss_replay = [None]*n_replays
             predL_r = [None]*n_replays
             distilL_r = [None]*n_replays
 
             # Run model (if [x_] is not a list with separate replay per task and there is no task-specific mask)
+            # -if there is only one replay (and active classes are the same for all samples), only compute its classes
+            classes_selected_ = (not fused_forward) and (n_replays==1) and (task_ids_ is None)
             if (not type(x_)==list) and (self.mask_dict is None):
-                y_hat_all = self(x_)
+                y_hat_all = y_hat_fused_ if fused_forward else self(x_, classes=(
+                    active_classes[0] if (classes_selected_ and active_classes is not None) else None
+                ))
+            # -if there are task-specific masks, run replay of all tasks in one forward pass with for each sample the
+            #  mask of the task according to which it is evaluated (so a single backward pass is needed, which also
+            #  includes the EWC/SI-losses as these do not depend on the masks)
+            if self.mask_dict is not None:
+                x_list_ = x_ if type(x_)==list else [x_]*n_replays
+                if any(isinstance(module, torch.nn.BatchNorm1d) for module in self.modules()):
+                    #--> with batch-norm, the replay of each task is run separately (so it gets its own statistics)
+                    y_hat_per_replay = [self(x_temp_, task_ids=torch.full(
+                        (x_temp_.size(0),), replay_id+1, dtype=torch.long, device=x_temp_.device
+                    )) for replay_id, x_temp_ in enumerate(x_list_)]
+                else:
+                    sizes_ = [x_temp_.size(0) for x_temp_ in x_list_]
+                    device_ = x_list_[0].device
+                    task_ids_masks_ = torch.repeat_interleave(
+                        torch.arange(1, n_replays+1, device=device_), torch.tensor(sizes_, device=device_)
+                    )
+                    y_hat_per_replay = self(torch.cat(x_list_), task_ids=task_ids_masks_).split(sizes_)
 
             # Loop to evalute predictions on replay according to each previous task
             for replay_id in range(n_replays):
 
                 # -if [x_] is a list with separate replay per task, evaluate model on this task's replay
-                if (type(x_)==list) or (self.mask_dict is not None):
-                    x_temp_ = x_[replay_id] if type(x_)==list else x_
-                    if self.mask_dict is not None:
-                        self.apply_XdGmask(task=replay_id+1)
-                    y_hat_all = self(x_temp_)
+                if self.mask_dict is not None:
+                    y_hat_all = y_hat_per_replay[replay_id]
+                elif type(x_)==list:
+                    classes_selected_ = (task_ids_ is None)
+                    y_hat_all = self(x_[replay_id], classes=(
+                        active_classes[replay_id] if (classes_selected_ and active_classes is not None) else None
+                    ))
 
                 # -if needed (e.g., Task-IL or Class-IL scenario), remove predictions for classes not in replayed task
-                y_hat = y_hat_all if (active_classes is None) else y_hat_all[:, active_classes[replay_id]]
+                if task_ids_ is not None:
+                    y_hat = y_hat_all.gather(1, class_entries_)
+                elif classes_selected_ and (self.mask_dict is None):
+                    y_hat = y_hat_all  #--> only predictions for active classes were computed
+                else:
+                    y_hat = y_hat_all if (active_classes is None) else utils.select_classes(
+                        y_hat_all, active_classes[replay_id]
+                    )
 
                 # Calculate losses
                 if (y_ is not None) and (y_[replay_id] is not None):
@@ -131,43 +194,49 @@ class Classifier(ContinualLearner, Replayer, ExemplarHandler):
                         binary_targets_ = utils.to_one_hot(y_[replay_id].cpu(), y_hat.size(1)).to(y_[replay_id].device)
                         predL_r[replay_id] = F.binary_cross_entropy_with_logits(
                             input=y_hat, target=binary_targets_, reduction='none'
-                        ).sum(dim=1).mean()     #--> sum over classes, then average over batch
+                        ).sum(dim=1)            #--> sum over classes
                     else:
-                        predL_r[replay_id] = F.cross_entropy(y_hat, y_[replay_id], reduction='mean')
+                        predL_r[replay_id] = F.cross_entropy(y_hat, y_[replay_id], reduction='none')
+                    # -average over batch (if [weights_] is provided, this is done per task)
+                    predL_r[replay_id] = predL_r[replay_id].mean() if (weights_ is None) else (
+                        weights_*predL_r[replay_id]
+                    ).sum()
                 if (scores_ is not None) and (scores_[replay_id] is not None):
                     # n_classes_to_consider = scores.size(1) #--> with this version, no zeroes are added to [scores]!
                     n_classes_to_consider = y_hat.size(1)    #--> zeros will be added to [scores] to make it this size!
                     kd_fn = utils.loss_fn_kd_binary if self.binaryCE else utils.loss_fn_kd
                     distilL_r[replay_id] = kd_fn(scores=y_hat[:, :n_classes_to_consider],
-                                                 target_scores=scores_[replay_id], T=self.KD_temp)
+                                                 target_scores=scores_[replay_id], T=self.KD_temp, weights=weights_)
                 # Weigh losses
                 if self.replay_targets=="hard":
                     loss_replay[replay_id] = predL_r[replay_id]
                 elif self.replay_targets=="soft":
                     loss_replay[replay_id] = distilL_r[replay_id]
 
-                # If needed, perform backward pass before next task-mask (gradients of all tasks will be accumulated)
-                if gradient_per_task:
-                    weight = 1 if self.AGEM else (1 - rnt)
-                    weighted_replay_loss_this_task = weight * loss_replay[replay_id] / n_replays
-                    weighted_replay_loss_this_task.backward()
-
         # Calculate total replay loss
         loss_replay = None if (x_ is None) else sum(loss_replay) / n_replays
 
         # If using A-GEM, calculate and store averaged gradient of replayed data
         if self.AGEM and x_ is not None:
-            # Perform backward pass to calculate gradient of replayed batch (if not yet done)
-            if not gradient_per_task:
-                loss_replay.backward()
+            # Perform backward pass to calculate gradient of replayed batch
+            loss_replay.backward()
             # Reorganize the gradient of the replayed batch as a single vector
-            grad_rep = []
-            for p in self.parameters():
-                if p.requires_grad:
-                    grad_rep.append(p.grad.view(-1))
-            grad_rep = torch.cat(grad_rep)
+            if self.param_arena is not None:
+                # -with parameter arena, it only needs to be copied (into a buffer that is re-used at every step)
+                if getattr(self, "grad_rep_arena", None) is None:
+                    self.grad_rep_arena = torch.empty_like(self.grad_arena)
+                grad_rep = self.grad_rep_arena.copy_(self.grad_arena)
+            else:
+                grad_rep = []
+                for p in self.parameters():
+                    if p.requires_grad:
+                        grad_rep.append(p.grad.view(-1))
+                grad_rep = torch.cat(grad_rep)
             # Reset gradients (with A-GEM, gradients of replayed batch should only be used as inequality constraint)
-            self.optimizer.zero_grad()
+            if self.param_arena is not None:
+                self.zero_grad_arena()
+            else:
+                self.optimizer.zero_grad()
 
 
         ##--(2)-- CURRENT DATA --##
@@ -177,12 +246,14 @@ class Classifier(ContinualLearner, Replayer, ExemplarHandler):
             if self.mask_dict is not None:
                 self.apply_XdGmask(task=task)
 
-            # Run model
-            y_hat = self(x)
-            # -if needed, remove predictions for classes not in current task
-            if active_classes is not None:
-                class_entries = active_classes[-1] if type(active_classes[0])==list else active_classes
-                y_hat = y_hat[:, class_entries]
+            # Run model (if not yet done), if needed only for the classes in current task
+            class_entries = None if (active_classes is None) else (
+                active_classes[-1] if type(active_classes[0])==list else active_classes
+            )
+            if fused_forward:
+                y_hat = utils.select_classes(y_hat_fused[:x.size(0)], class_entries)
+            else:
+                y_hat = self(x, classes=class_entries)
 
             # Calculate prediction loss
             if self.binaryCE:
@@ -204,11 +275,6 @@ class Classifier(ContinualLearner, Replayer, ExemplarHandler):
 
             # Calculate training-precision
             precision = None if y is None else (y == y_hat.max(1)[1]).sum().item() / x.size(0)
-
-            # If backward passes are performed per task (e.g., XdG combined with replay), perform backward pass
-            if gradient_per_task:
-                weighted_current_loss = rnt*loss_cur
-                weighted_current_loss.backward()
         else:
             precision = predL = None
             # -> it's possible there is only "replay" [e.g., for offline with task-incremental learning]
@@ -216,62 +282,81 @@ class Classifier(ContinualLearner, Replayer, ExemplarHandler):
 
         # Combine loss from current and replayed batch
         if x_ is None or self.AGEM:
-            loss_total = loss_cur
+            # -(with task-specific masks, the loss on the current data is weighted as when backpropagated per task)
+            masked_agem = self.AGEM and (x is not None) and (x_ is not None) and (self.mask_dict is not None)
+            loss_total = rnt*loss_cur if masked_agem else loss_cur
         else:
             loss_total = loss_replay if (x is None) else rnt*loss_cur+(1-rnt)*loss_replay
 
 
         ##--(3)-- ALLOCATION LOSSES --##
+        # (if [inject_reg_grads], these are not added to [loss_total], but their gradients are added after backward)
 
         # Add SI-loss (Zenke et al., 2017)
-        surrogate_loss = self.surrogate_loss()
-        if self.si_c>0:
+        surrogate_loss = self.surrogate_loss() if (self.si_c>0 and not self.inject_reg_grads) else None
+        if surrogate_loss is not None:
             loss_total += self.si_c * surrogate_loss
 
         # Add EWC-loss
-        ewc_loss = self.ewc_loss()
-        if self.ewc_lambda>0:
+        ewc_loss = self.ewc_loss() if (self.ewc_lambda>0 and not self.inject_reg_grads) else None
+        if ewc_loss is not None:
             loss_total += self.ewc_lambda * ewc_loss
 
 
-        # Backpropagate errors (if not yet done)
-        if not gradient_per_task:
-            loss_total.backward()
+        # Backpropagate errors
+        loss_total.backward()
+
+        # If requested, add gradients of SI- and EWC-loss directly
+        if self.inject_reg_grads:
+            self.add_regularizer_grads()
 
         # If using A-GEM, potentially change gradient:
         if self.AGEM and x_ is not None:
             # -reorganize gradient (of current batch) as single vector
-            grad_cur = []
-            for p in self.parameters():
-                if p.requires_grad:
-                    grad_cur.append(p.grad.view(-1))
-            grad_cur = torch.cat(grad_cur)
+            if self.param_arena is not None:
+                grad_cur = self.grad_arena
+            else:
+                grad_cur = []
+                for p in self.parameters():
+                    if p.requires_grad:
+                        grad_cur.append(p.grad.view(-1))
+                grad_cur = torch.cat(grad_cur)
             # -check inequality constrain
-            angle = (grad_cur*grad_rep).sum()
+            angle = grad_cur.dot(grad_rep)
             if angle < 0:
                 # -if violated, project the gradient of the current batch onto the gradient of the replayed batch ...
-                length_rep = (grad_rep*grad_rep).sum()
-                grad_proj = grad_cur-(angle/length_rep)*grad_rep
-                # -...and replace all the gradients within the model with this projected gradient
-                index = 0
-                for p in self.parameters():
-                    if p.requires_grad:
-                        n_param = p.numel()  # number of parameters in [p]
-                        p.grad.copy_(grad_proj[index:index+n_param].view_as(p))
-                        index += n_param
+                length_rep = grad_rep.dot(grad_rep)
+                if self.param_arena is not None:
+                    # -...which, with parameter arena, can be done in place
+                    self.grad_arena.add_(grad_rep, alpha=-(angle/length_rep).item())
+                else:
+                    grad_proj = grad_cur-(angle/length_rep)*grad_rep
+                    # -...and replace all the gradients within the model with this projected gradient
+                    index = 0
+                    for p in self.parameters():
+                        if p.requires_grad:
+                            n_param = p.numel()  # number of parameters in [p]
+                            p.grad.copy_(grad_proj[index:index+n_param].view_as(p))
+                            index += n_param
 
         # Take optimization-step
         self.optimizer.step()
 
         # Return the dictionary with different training-loss split in categories
-        return {
+        # (if SI- and EWC-loss were not computed, their values are only computed if requested)
+        return utils.LazyDict({
             'loss_total': loss_total.item(),
             'loss_current': loss_cur.item() if x is not None else 0,
             'loss_replay': loss_replay.item() if (loss_replay is not None) and (x is not None) else 0,
             'pred': predL.item() if predL is not None else 0,
             'pred_r': sum(predL_r).item()/n_replays if (x_ is not None and predL_r[0] is not None) else 0,
             'distil_r': sum(distilL_r).item()/n_replays if (x_ is not None and distilL_r[0] is not None) else 0,
-            'ewc': ewc_loss.item(), 'si_loss': surrogate_loss.item(),
+            'ewc': ewc_loss.item() if (ewc_loss is not None) else (
+                functools.partial(utils.loss_value, self.ewc_loss) if self.ewc_lambda>0 else 0.
+            ),
+            'si_loss': surrogate_loss.item() if (surrogate_loss is not None) else (
+                functools.partial(utils.loss_value, self.surrogate_loss) if self.si_c>0 else 0.
+            ),
             'precision': precision if precision is not None else 0.,
-        }
+        })
 
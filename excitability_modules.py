@@ -1,6 +1,7 @@
 import math
 import torch
 from torch import nn
+from torch.nn import functional as F
 from torch.nn.parameter import Parameter
 
 
@@ -15,13 +16,12 @@ def linearExcitability(input, weight, excitability=None, bias=None):
         - output:       :math:`(N, *, out_features)`
     (NOTE: `*` means any number of additional dimensions)'''
 
-    if excitability is not None:
-        output = input.matmul(weight.t()) * excitability
+    if excitability is None:
+        return F.linear(input, weight, bias)  # -> single fused op (i.e., addmm)
+    elif bias is None:
+        return input.matmul(weight.t()) * excitability
     else:
-        output = input.matmul(weight.t())
-    if bias is not None:
-        output += bias
-    return output
+        return torch.addcmul(bias, input.matmul(weight.t()), excitability)
 
 
 class LinearExcitability(nn.Module):
@@ -42,7 +42,14 @@ class LinearExcitability(nn.Module):
         weight:         the learnable weights of the module of shape (out_features x in_features)
         excitability:   the learnable multiplication terms (out_features)
         bias:           the learnable bias of the module of shape (out_features)
-        excit_buffer:   fixed multiplication variable (out_features)'''
+        excit_buffer:   fixed multiplication variable (out_features)
+        XdG_masks:      (if set, see [ContinualLearner.build_XdGmasks]) table with "excit-buffer" for each task
+        active_units:   None or indeces of units that are not gated by current "excit-buffer" (if set, only the output
+                            of these units is computed, as the output of all other units is just the bias)
+        excit_buffer_identity:  whether "excit-buffer" only contains ones (in which case it is skipped)
+
+    The "excit-buffer" should preferably be changed with [set_excit_buffer]; if it is changed in any other way, whether
+    it only contains ones is re-checked at the next forward pass.'''
 
     def __init__(self, in_features, out_features, bias=True, excitability=False, excit_buffer=False):
         super(LinearExcitability, self).__init__()
@@ -62,6 +69,10 @@ class LinearExcitability(nn.Module):
             self.register_buffer("excit_buffer", buffer)
         else:
             self.register_buffer("excit_buffer", None)
+        self.active_units = None
+        self._excit_buffer_identity = True
+        self._identity_key = None
+        self._folded_weight = self._folded_key = None
         self.reset_parameters()
 
     def reset_parameters(self):
@@ -73,18 +84,105 @@ class LinearExcitability(nn.Module):
         if self.bias is not None:
             self.bias.data.uniform_(-stdv, stdv)
 
-    def forward(self, input):
+    def __getstate__(self):
+        '''Copies of this module (e.g., snapshots for replay or modules sent to another process) do not get the cached
+        folded weight-matrix, and re-check their own "excit-buffer".'''
+        state = self.__dict__.copy()
+        state['_folded_weight'] = state['_folded_key'] = state['_identity_key'] = None
+        return state
+
+    @staticmethod
+    def _tensor_key(tensor):
+        return None if (tensor is None) else (tensor.data_ptr(), tensor._version)
+
+    def set_excit_buffer(self, excit_buffer, identity=None):
+        '''Point "excit-buffer" to [excit_buffer] (e.g., a row of [XdG_masks]).
+
+        [identity]  None or <bool>, whether [excit_buffer] only contains ones (if None, this is checked when needed)'''
+        self.excit_buffer = excit_buffer
+        self._excit_buffer_identity = identity
+        self._identity_key = None if (identity is None) else self._tensor_key(excit_buffer)
+
+    @property
+    def excit_buffer_identity(self):
+        '''Whether "excit-buffer" only contains ones. This is only re-checked if "excit-buffer" has been changed (i.e.,
+        written to in-place or pointed to another tensor) since the previous check or call to [set_excit_buffer].'''
+        if self.excit_buffer is None:
+            return True
+        key = self._tensor_key(self.excit_buffer)
+        if key!=self._identity_key:
+            self._excit_buffer_identity = bool((self.excit_buffer==1).all())
+            self._identity_key = key
+        return self._excit_buffer_identity
+
+    def forward(self, input, task_ids=None, out_slice=None):
         '''Running this model's forward step requires/returns:
             -[input]:   [batch_size]x[...]x[in_features]
-            -[output]:  [batch_size]x[...]x[hidden_features]'''
-        if self.excit_buffer is None:
+            -[output]:  [batch_size]x[...]x[hidden_features]
+
+        If [task_ids] (<tensor> with for each sample in [input] a row of [XdG_masks]) is provided and this layer has
+        a table with masks, the mask applied to each sample is taken from this table (instead of [excit_buffer]).
+        If [out_slice] (<slice>) is provided, only the output of the units in this slice is computed and returned.'''
+        if out_slice is not None:
+            # -only use corresponding (contiguous) rows of weight-matrix, which are views (so no copies are made)
+            excit_buffer = None if (self.excit_buffer is None or self.excit_buffer_identity) else (
+                self.excit_buffer[out_slice]
+            )
+            excitability = None if (self.excitability is None) else self.excitability[out_slice]
+            if excit_buffer is not None:
+                excitability = excit_buffer if (excitability is None) else excitability*excit_buffer
+            bias = None if (self.bias is None) else self.bias[out_slice]
+            return linearExcitability(input, self.weight[out_slice], excitability, bias)
+        elif (task_ids is None) and (self.active_units is not None):
+            # -only compute output of units that are not gated (i.e., only use corresponding rows of weight-matrix)
+            #  (as with the dense mask, gated units only output the bias and their rows of [weight] get zero gradient)
+            excitability = None if (self.excitability is None) else self.excitability.index_select(0, self.active_units)
+            output_active = linearExcitability(input, self.weight.index_select(0, self.active_units), excitability)
+            output = input.new_zeros(*input.size()[:-1], self.out_features).index_copy(
+                -1, self.active_units, output_active
+            )
+            return output if (self.bias is None) else output+self.bias
+        elif (task_ids is not None) and (getattr(self, 'XdG_masks', None) is not None):
+            excit_buffer = self.XdG_masks[task_ids]
+            excitability = excit_buffer if (self.excitability is None) else self.excitability*excit_buffer
+            return linearExcitability(input, self.weight, excitability, self.bias)
+
+        # If "excit-buffer" only contains ones, it is skipped
+        excit_buffer = None if self.excit_buffer_identity else self.excit_buffer
+        if (excit_buffer is None) and (self.excitability is None):
+            return linearExcitability(input, self.weight, None, self.bias)
+
+        # If this layer is frozen (e.g., copy of model used for replay), excitability is folded into rows of weights
+        # (for layers that are trained, this is not done, so that they do not hold a second copy of the weight-matrix)
+        frozen = not (self.weight.requires_grad or (
+            (self.excitability is not None) and self.excitability.requires_grad
+        ))
+        if frozen:
+            return F.linear(input, self.folded_weight(excit_buffer), self.bias)
+
+        if excit_buffer is None:
             excitability = self.excitability
         elif self.excitability is None:
-            excitability = self.excit_buffer
+            excitability = excit_buffer
         else:
-            excitability = self.excitability*self.excit_buffer
+            excitability = self.excitability*excit_buffer
         return linearExcitability(input, self.weight, excitability, self.bias)
 
+    def folded_weight(self, excit_buffer=None):
+        '''Return [weight] with each row multiplied by its total excitability (i.e., [excitability]*[excit_buffer]).
+
+        The result is cached, and only re-computed if [weight], [excitability] or [excit_buffer] is changed (or if
+        [excit_buffer] is pointed to another tensor, e.g. when another mask is applied). No gradients are computed.'''
+        key = tuple(self._tensor_key(t) for t in (self.weight, self.excitability, excit_buffer))
+        if key!=self._folded_key:
+            with torch.no_grad():
+                excitability = self.excitability if (excit_buffer is None) else (
+                    excit_buffer if (self.excitability is None) else self.excitability*excit_buffer
+                )
+                self._folded_weight = self.weight * excitability.unsqueeze(1)
+            self._folded_key = key
+        return self._folded_weight
+
     def __repr__(self):
         return self.__class__.__name__ + '(' \
                + 'in_features=' + str(self.in_features) \
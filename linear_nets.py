@@ -28,9 +28,11 @@ class fc_layer(nn.Module):
         elif not nl=="none":
             self.nl = nn.ReLU() if nl == "relu" else (nn.LeakyReLU() if nl == "leakyrelu" else utils.Identity())
 
-    def forward(self, x, return_pa=False):
+    def forward(self, x, return_pa=False, task_ids=None, out_slice=None):
+        '''If [out_slice] (<slice>) is provided, only these units are computed (not with batch-norm or gate).'''
         input = self.dropout(x) if hasattr(self, 'dropout') else x
-        pre_activ = self.bn(self.linear(input)) if hasattr(self, 'bn') else self.linear(input)
+        pre_activ = self.linear(input, task_ids=task_ids, out_slice=out_slice)
+        pre_activ = self.bn(pre_activ) if hasattr(self, 'bn') else pre_activ
         gate = self.sigmoid(self.gate(x)) if hasattr(self, 'gate') else None
         gated_pre_activ = gate * pre_activ if hasattr(self, 'gate') else pre_activ
         output = self.nl(gated_pre_activ) if hasattr(self, 'nl') else gated_pre_activ
@@ -56,8 +58,8 @@ class fc_layer_split(nn.Module):
         self.logvar = fc_layer(in_size, out_size, drop=drop, bias=False, excitability=excitability,
                                excit_buffer=excit_buffer, batch_norm=batch_norm, gated=gated, nl=nl_logvar)
 
-    def forward(self, x):
-        return (self.mean(x), self.logvar(x))
+    def forward(self, x, task_ids=None):
+        return (self.mean(x, task_ids=task_ids), self.logvar(x, task_ids=task_ids))
 
     def list_init_layers(self):
         '''Return list of modules whose parameters could be initialized differently (i.e., conv- or fc-layers).'''
@@ -143,9 +145,10 @@ class MLP(nn.Module):
         if self.layers<1:
             self.noLayers = utils.Identity()
 
-    def forward(self, x):
+    def forward(self, x, task_ids=None):
+        '''If [task_ids] is provided, each sample in [x] is run with the task-specific mask of its task.'''
         for lay_id in range(1, self.layers+1):
-            x = getattr(self, 'fcLayer{}'.format(lay_id))(x)
+            x = getattr(self, 'fcLayer{}'.format(lay_id))(x, task_ids=task_ids)
         return x
 
     @property
@@ -46,6 +46,8 @@ task_params.add_argument('--experiment', type=str, default='splitMNIST', choices
 task_params.add_argument('--scenario', type=str, default='class', choices=['task', 'domain', 'class'])
 task_params.add_argument('--tasks', type=int, help='number of tasks')
 task_params.add_argument('--runs', type=int,default=1) #new
+task_params.add_argument('--cache-data', action='store_true', help="decode datasets only once (MNIST/CIFAR10: in memory,"
+                                                                  " image-folders: memory-mapped file in data-dir)")
 
 
 # specify loss functions to be used
@@ -70,6 +72,10 @@ train_params.add_argument('--iters', type=int, help="# batches to optimize solve
 train_params.add_argument('--lr', type=float, help="learning rate")
 train_params.add_argument('--batch', type=int, default=128, help="batch-size")
 train_params.add_argument('--optimizer', type=str, choices=['adam', 'adam_reset', 'sgd'], default='adam')
+train_params.add_argument('--workers', type=int, default=0, help="# worker processes per training data-loader")
+train_params.add_argument('--prefetch', type=int, default=0, help="# batches to prepare in background thread (0: off)")
+train_params.add_argument('--flat-params', action='store_true', help="store all parameters (and gradients) in single"
+                                                                       " contiguous tensor")
 
 # "memory replay" parameters
 replay_params = parser.add_argument_group('Replay Parameters')
@@ -80,6 +86,16 @@ replay_params.add_argument('--replay', type=str, default='none', choices=replay_
 replay_params.add_argument('--distill', action='store_true', help="use distillation for replay?")
 replay_params.add_argument('--temp', type=float, default=2., dest='temp', help="temperature for distillation")
 replay_params.add_argument('--agem', action='store_true', help="use gradient of replay as inequality constraint")
+replay_params.add_argument('--teacher-dtype', type=str, default='float', choices=['float', 'bfloat16', 'float16'],
+                           help="data type of copy of model used for replay")
+replay_params.add_argument('--cache-teacher', action='store_true',
+                           help="score fixed data with previous model at once (current data / stored data for soft targets)")
+replay_params.add_argument('--replay-pool', type=int, default=0, dest='pool_size',
+                           help="generative replay: draw from pool of this many pre-generated samples (0: per batch)")
+replay_params.add_argument('--pool-chunk', type=int, default=1000, help="# samples generated at once for pool")
+replay_params.add_argument('--pool-refresh', type=int, help="# samples in pool replaced per batch (default: batch)")
+replay_params.add_argument('--fuse-replay', action='store_true', help="run current & replayed data through model in"
+                                                                       " single forward pass (if possible)")
 # -generative model parameters (if separate model)
 genmodel_params = parser.add_argument_group('Generative Model Parameters')
 genmodel_params.add_argument('--g-z-dim', type=int, default=100, help='size of latent representation (default: 100)')
@@ -89,20 +105,36 @@ genmodel_params.add_argument('--g-fc-uni', type=int, help='[fc_units] in generat
 gen_params = parser.add_argument_group('Generator Hyper Parameters')
 gen_params.add_argument('--g-iters', type=int, help="# batches to train generator (default: as classifier)")
 gen_params.add_argument('--lr-gen', type=float, help="learning rate generator (default: lr)")
+gen_params.add_argument('--gen-worker', action='store_true', help="train generator in separate process")
 
 # "memory allocation" parameters
 cl_params = parser.add_argument_group('Memory Allocation Parameters')
 cl_params.add_argument('--ewc', action='store_true', help="use 'EWC' (Kirkpatrick et al, 2017)")
 cl_params.add_argument('--lambda', type=float, dest="ewc_lambda", help="--> EWC: regularisation strength")
 cl_params.add_argument('--fisher-n', type=int, help="--> EWC: sample size estimating Fisher Information")
+cl_params.add_argument('--fisher-tol', type=float, help="--> EWC: stop estimating Fisher Information once relative"
+                                                       " change of its norm is below this")
+cl_params.add_argument('--fisher-chunk', type=int, default=128, help="--> EWC: # samples after which convergence of"
+                                                                     " Fisher Information is checked")
+cl_params.add_argument('--fisher-batch', type=int, default=1, help="--> EWC: # samples for which gradients are computed"
+                                                                       " at once when estimating Fisher Information")
 cl_params.add_argument('--online', action='store_true', help="--> EWC: perform 'online EWC'")
 cl_params.add_argument('--gamma', type=float, help="--> EWC: forgetting coefficient (for 'online EWC')")
 cl_params.add_argument('--emp-fi', action='store_true', help="--> EWC: estimate FI with provided labels")
+cl_params.add_argument('--consolidate', action='store_true', help="--> EWC: (offline) store all tasks' quadratic terms"
+                                                                   " as single term")
+cl_params.add_argument('--ewc-task-dir', type=str, help="--> EWC: (offline, consolidated) dir to save each task's term")
 cl_params.add_argument('--si', action='store_true', help="use 'Synaptic Intelligence' (Zenke, Poole et al, 2017)")
 cl_params.add_argument('--c', type=float, dest="si_c", help="--> SI: regularisation strength")
 cl_params.add_argument('--epsilon', type=float, default=0.1, dest="epsilon", help="--> SI: dampening parameter")
+cl_params.add_argument('--importance-storage', type=str, default='float',
+                       choices=['float', 'bfloat16', 'float16', 'topk'], help="EWC/SI: how to store precision/omega")
+cl_params.add_argument('--importance-topk', type=float, default=0.1, help="EWC/SI: prop of precision/omega to keep")
+cl_params.add_argument('--inject-grads', action='store_true', help="EWC/SI: add gradients of losses directly to"
+                                                                    " gradients (without autograd)")
 cl_params.add_argument('--xdg', action='store_true', help="Use 'Context-dependent Gating' (Masse et al, 2018)")
 cl_params.add_argument('--gating-prop', type=float, metavar="PROP", help="--> XdG: prop neurons per layer to gate")
+cl_params.add_argument('--xdg-sparse', action='store_true', help="--> XdG: only compute output of non-gated neurons")
 
 # data storage ('exemplars') parameters
 store_params = parser.add_argument_group('Data Storage Parameters')
@@ -161,11 +193,9 @@ def run(args, verbose=False):
     # -if binary classification loss is selected together with 'feedback', give error
     if args.feedback and args.bce:
         raise NotImplementedError("Binary classification loss not supported with feedback connections.")
-    # -if XdG is selected together with both replay and EWC, give error (either one of them alone with XdG is fine)
-    if (args.xdg and args.gating_prop>0) and (not args.replay=="none") and (args.ewc or args.si):
-        raise NotImplementedError("XdG is not supported with both '{}' replay and EWC / SI.".format(args.replay))
-        #--> problem is that applying different task-masks interferes with gradient calculation
-        #    (should be possible to overcome by calculating backward step on EWC/SI-loss also for each mask separately)
+    # -if top-k storage of precision/omega is selected together with the parameter arena, give error
+    if getattr(args, "importance_storage", "float")=="topk" and getattr(args, "flat_params", False):
+        raise NotImplementedError("Top-k storage of precision / omega is not supported with '--flat-params'.")
     # -if 'BCEdistill' is selected for other than scenario=="class", give error
     if args.bce_distill and not args.scenario=="class":
         raise ValueError("BCE-distill can only be used for class-incremental learning.")
@@ -215,11 +245,13 @@ def run(args, verbose=False):
       (train_datasets, test_datasets, original_datasets), config, classes_per_task = get_multitask_experiment(
         name=args.experiment, scenario=scenario, tasks=args.tasks, data_dir=args.d_dir,
         verbose=verbose, exception=True if args.seed==0 else False,
+        cache_data=hasattr(args, "cache_data") and args.cache_data,
     )
     else:
       (train_datasets, test_datasets), config, classes_per_task = get_multitask_experiment(
         name=args.experiment, scenario=scenario, tasks=args.tasks, data_dir=args.d_dir,
-        verbose=verbose, exception=True if args.seed==0 else False,)
+        verbose=verbose, exception=True if args.seed==0 else False,
+        cache_data=hasattr(args, "cache_data") and args.cache_data,)
       original_datasets= None
       
     result_list =[] # NEEED REUPDATE!!!!!!!!!!!!!!!
@@ -282,9 +314,14 @@ def run(args, verbose=False):
         model.ewc_lambda = args.ewc_lambda if args.ewc else 0
         if args.ewc:
             model.fisher_n = args.fisher_n
+            model.fisher_batch = args.fisher_batch if hasattr(args, "fisher_batch") else 1
+            model.fisher_tol = args.fisher_tol if hasattr(args, "fisher_tol") else None
+            model.fisher_chunk = args.fisher_chunk if hasattr(args, "fisher_chunk") else 128
             model.gamma = args.gamma
             model.online = args.online
             model.emp_FI = args.emp_fi
+            model.consolidate_EWC = hasattr(args, "consolidate") and args.consolidate
+            model.EWC_task_dir = args.ewc_task_dir if hasattr(args, "ewc_task_dir") else None
 
     # Synpatic Intelligence (SI)
     if isinstance(model, ContinualLearner):
@@ -292,21 +329,31 @@ def run(args, verbose=False):
         if args.si:
             model.epsilon = args.epsilon
 
+    # -EWC & SI: compute gradients of their losses directly (instead of with autograd)?
+    if isinstance(model, ContinualLearner):
+        model.inject_reg_grads = hasattr(args, "inject_grads") and args.inject_grads
+    # -EWC & SI: how to store the precision (EWC) and omega (SI)?
+    if isinstance(model, ContinualLearner) and hasattr(args, "importance_storage"):
+        model.importance_storage = args.importance_storage
+        model.importance_topk = args.importance_topk
+
+    # Parameter arena: if requested, make all trainable parameters (and their gradients) views into one flat tensor
+    if isinstance(model, Classifier) and hasattr(args, "flat_params") and args.flat_params:
+        model.build_param_arena()
+
     # XdG: create for every task a "mask" for each hidden fully connected layer
     if isinstance(model, ContinualLearner) and (args.xdg and args.gating_prop>0):
         mask_dict = {}
-        excit_buffer_list = []
+        XdG_layers = [getattr(model.fcE, "fcLayer{}".format(i+1)).linear for i in range(model.fcE.layers)]
         for task_id in range(args.tasks):
             mask_dict[task_id+1] = {}
-            for i in range(model.fcE.layers):
-                layer = getattr(model.fcE, "fcLayer{}".format(i+1)).linear
-                if task_id==0:
-                    excit_buffer_list.append(layer.excit_buffer)
+            for i, layer in enumerate(XdG_layers):
                 n_units = len(layer.excit_buffer)
                 gated_units = np.random.choice(n_units, size=int(args.gating_prop*n_units), replace=False)
                 mask_dict[task_id+1][i] = gated_units
         model.mask_dict = mask_dict
-        model.excit_buffer_list = excit_buffer_list
+        # -precompute all masks on the model's device (so switching masks does not require any allocation or copying)
+        model.build_XdGmasks(XdG_layers, sparse=args.xdg_sparse if hasattr(args, "xdg_sparse") else False)
 
 
     #-------------------------------------------------------------------------------------------------#
@@ -319,6 +366,9 @@ def run(args, verbose=False):
     if isinstance(model, Replayer):
         model.replay_targets = "soft" if args.distill else "hard"
         model.KD_temp = args.temp
+    # -run current and replayed data through model in single forward pass?
+    if isinstance(model, Classifier):
+        model.fuse_replay = hasattr(args, "fuse_replay") and args.fuse_replay
 
     # If needed, specify separate model for the generator
     train_gen = True if (args.replay=="generative" and not args.feedback) else False
@@ -457,6 +507,14 @@ def run(args, verbose=False):
         generator=generator, gen_iters=args.g_iters, gen_loss_cbs=generator_loss_cbs,
         sample_cbs=sample_cbs, eval_cbs=eval_cbs, loss_cbs=generator_loss_cbs if args.feedback else solver_loss_cbs,
         metric_cbs=metric_cbs, use_exemplars=args.use_exemplars, add_exemplars=args.add_exemplars,
+        num_workers=args.workers if hasattr(args, "workers") else 0,
+        prefetch=args.prefetch if hasattr(args, "prefetch") else 0,
+        teacher_dtype=None if getattr(args, "teacher_dtype", "float")=="float" else getattr(torch, args.teacher_dtype),
+        cache_teacher=args.cache_teacher if hasattr(args, "cache_teacher") else False,
+        pool_size=args.pool_size if hasattr(args, "pool_size") else 0,
+        pool_chunk=args.pool_chunk if hasattr(args, "pool_chunk") else 1000,
+        pool_refresh=args.pool_refresh if hasattr(args, "pool_refresh") else None,
+        generator_worker=args.gen_worker if hasattr(args, "gen_worker") else False, seed=args.seed,
     )
     # Get total training-time in seconds, and write to file
     if args.time:
@@ -465,6 +523,10 @@ def run(args, verbose=False):
         time_file.write('{}\n'.format(training_time))
         time_file.close()
 
+    # If EWC, store # of samples used for estimating the Fisher Information after each task
+    if (metrics_dict is not None) and isinstance(model, ContinualLearner) and (model.ewc_lambda>0):
+        metrics_dict['fisher samples per task'] = model.fisher_n_used
+
 
     #-------------------------------------------------------------------------------------------------#
 
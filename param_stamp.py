@@ -72,18 +72,28 @@ def get_param_stamp(args, model_name, verbose=True, replay=False, replay_model_n
 
     # -for EWC / SI
     if hasattr(args, 'ewc') and ((args.ewc_lambda>0 and args.ewc) or (args.si_c>0 and args.si)):
-        ewc_stamp = "EWC{l}-{fi}{o}".format(
+        fisher_tol = getattr(args, "fisher_tol", None)
+        ewc_stamp = "EWC{l}-{fi}{tol}{o}".format(
             l=args.ewc_lambda,
             fi="{}{}".format("N" if args.fisher_n is None else args.fisher_n, "E" if args.emp_fi else ""),
+            tol="" if fisher_tol is None else "-tol{}{}".format(
+                fisher_tol, "" if getattr(args, "fisher_chunk", 128)==128 else "c{}".format(args.fisher_chunk)
+            ),
             o="-O{}".format(args.gamma) if args.online else "",
         ) if (args.ewc_lambda>0 and args.ewc) else ""
         si_stamp = "SI{c}-{eps}".format(c=args.si_c, eps=args.epsilon) if (args.si_c>0 and args.si) else ""
         both = "--" if (args.ewc_lambda>0 and args.ewc) and (args.si_c>0 and args.si) else ""
+        storage = getattr(args, "importance_storage", "float")
+        storage_stamp = "" if storage=="float" else "-{}{}".format(
+            storage, args.importance_topk if storage=="topk" else ""
+        )
         if verbose and args.ewc_lambda>0 and args.ewc:
             print(" --> EWC:           " + ewc_stamp)
         if verbose and args.si_c>0 and args.si:
             print(" --> SI:            " + si_stamp)
-    ewc_stamp = "--{}{}{}".format(ewc_stamp, both, si_stamp) if (
+        if verbose and not storage=="float":
+            print(" --> storage:       " + "precision / omega stored as {}".format(storage_stamp[1:]))
+    ewc_stamp = "--{}{}{}{}".format(ewc_stamp, both, si_stamp, storage_stamp) if (
         hasattr(args, 'ewc') and ((args.ewc_lambda>0 and args.ewc) or (args.si_c>0 and args.si))
     ) else ""
 
@@ -96,14 +106,18 @@ def get_param_stamp(args, model_name, verbose=True, replay=False, replay_model_n
 
     # -for replay
     if replay:
-        replay_stamp = "{rep}{KD}{agem}{model}{gi}".format(
+        replay_stamp = "{rep}{KD}{agem}{model}{gi}{td}{pool}".format(
             rep=args.replay,
             KD="-KD{}".format(args.temp) if args.distill else "",
             agem="-aGEM" if args.agem else "",
             model="" if (replay_model_name is None) else "-{}".format(replay_model_name),
             gi="-gi{}".format(args.gen_iters) if (
                 hasattr(args, "gen_iters") and (replay_model_name is not None) and (not args.iters==args.gen_iters)
-            ) else ""
+            ) else "",
+            td="" if getattr(args, "teacher_dtype", "float")=="float" else "-t{}".format(args.teacher_dtype),
+            pool="-pool{}{}".format(args.pool_size, "" if getattr(args, "pool_refresh", None) is None else "r{}".format(
+                args.pool_refresh
+            )) if (args.replay=="generative" and getattr(args, "pool_size", 0)>0) else "",
         )
         if verbose:
             print(" --> replay:        " + replay_stamp)
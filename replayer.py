@@ -1,4 +1,6 @@
 import abc
+import copy
+import torch
 from torch import nn
 
 
@@ -27,6 +29,35 @@ class Replayer(nn.Module, metaclass=abc.ABCMeta):
     def _is_on_cuda(self):
         return next(self.parameters()).is_cuda
 
+    def snapshot_for_replay(self, dtype=None):
+        '''Return frozen copy of this model, to be used for replay (e.g., as "teacher" or as generator of previous tasks).
+
+        Only the parts needed to run the model are copied (i.e., architecture, parameters and buffers such as those for
+        XdG-masks), not the optimizer, stored exemplars, parameter arena or the buffers of EWC/SI. All parameters have
+        [requires_grad]=False. If [dtype] is provided, parameters and buffers are converted to it, in which case inputs
+        to [forward] are converted to it as well and its outputs are converted back to float.'''
+
+        # Objects that are not needed for replay are not copied (i.e., they are replaced by an empty list or None)
+        exclude = [getattr(self, name, None) for name in (
+            'optimizer', 'optim_list', 'exemplar_sets', 'exemplar_means', 'param_arena', 'grad_arena', 'grad_rep_arena'
+        )]
+        exclude += [buffer for name, buffer in self.named_buffers() if ('EWC_' in name) or ('SI_' in name)]
+        memo = {id(obj): (type(obj)() if isinstance(obj, list) else None) for obj in exclude if obj is not None}
+        snapshot = copy.deepcopy(self, memo)
+
+        # Freeze the copy (and, if requested, convert it to [dtype])
+        for p in snapshot.parameters():
+            p.requires_grad = False
+        if dtype is not None:
+            snapshot.to(dtype)
+            snapshot.register_forward_pre_hook(lambda module, input: tuple(
+                i.to(dtype) if (torch.is_tensor(i) and i.is_floating_point()) else i for i in input
+            ))
+            snapshot.register_forward_hook(
+                lambda module, input, output: output.float() if torch.is_tensor(output) else output
+            )
+        return snapshot.eval()
+
     @abc.abstractmethod
     def forward(self, x):
         pass
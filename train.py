@@ -1,19 +1,200 @@
+import copy
+import queue
+import traceback
 import torch
 from torch import optim
 from torch.utils.data import ConcatDataset
 import numpy as np
 import tqdm
-import copy
+import functools
 import utils
-from data import SubDataset, ExemplarDataset
+from data import SubDataset, ExemplarDataset, ScoredDataset
 from continual_learner import ContinualLearner
 import evaluate
 
 
+def _collect_batches(data_loader, data_loader_previous, device, y_offset=0, y_offsets_previous=None):
+    '''Collect next batch from [data_loader] and from [data_loader_previous], and move them to [device].
+
+    [data_loader]           None or iterator over batches of current task (if batches also contain scores, e.g. as
+                                provided by a <ScoredDataset>, these are returned as well)
+    [data_loader_previous]  None or (<list> with per previous task an) iterator over batches of previous task(s) (if
+                                these batches also contain scores, these are returned as well)
+    [y_offset]              <int>, to subtract from labels of current task (i.e., to get them into 'active range')
+    [y_offsets_previous]    <list> with for each previous task <int> to subtract from its labels (if
+                                [data_loader_previous] is a <list>), or <tensor> with for each replayed sample <int> to
+                                subtract from its label (if a single [data_loader_previous] replays multiple tasks)'''
+
+    x = y = scores = x_ = y_ = scores_ = None
+    if data_loader is not None:
+        batch = next(data_loader)
+        x, y = batch[0].to(device), (batch[1]-y_offset).to(device)
+        scores = batch[2].to(device) if len(batch)>2 else None
+    if type(data_loader_previous)==list:
+        x_ = list()
+        y_ = list()
+        scores_ = list()
+        for task_id, data_loader_task in enumerate(data_loader_previous):
+            batch = next(data_loader_task)
+            x_.append(batch[0].to(device))
+            y_.append((batch[1]-y_offsets_previous[task_id]).to(device))
+            scores_.append(batch[2].to(device) if len(batch)>2 else None)
+        scores_ = scores_ if (len(scores_)>0 and scores_[0] is not None) else None
+    elif data_loader_previous is not None:
+        batch = next(data_loader_previous)
+        x_, y_ = batch[0].to(device), batch[1].to(device)
+        scores_ = batch[2].to(device) if len(batch)>2 else None
+        if torch.is_tensor(y_offsets_previous):
+            y_ = y_-y_offsets_previous
+    return (x, y, scores, x_, y_, scores_)
+
+
+def _predict_scores(model, x, classes=None):
+    '''Return scores predicted by [model] for [x], if [classes] (<list>) is provided only those for these classes.
+
+    For a <Classifier>, only the logits of [classes] are computed (if they are contiguous).'''
+    if model.label=="Classifier":
+        return model(x, classes=classes)
+    return utils.select_classes(model(x), classes)
+
+
+def _generate_replay(generator, model, size):
+    '''Generate [size] samples with [generator] and return them together with the scores [model] predicts for them.'''
+    x_ = generator.sample(size)
+    with torch.no_grad():
+        scores_ = model(x_)
+    return (x_, scores_)
+
+
+def _to_cpu(state):
+    '''Return copy of (nested <dict>/<list> of) [state] with all <tensors> moved to cpu.'''
+    if torch.is_tensor(state):
+        return state.cpu()
+    elif isinstance(state, dict):
+        return {key: _to_cpu(value) for key, value in state.items()}
+    elif isinstance(state, (list, tuple)):
+        return type(state)(_to_cpu(value) for value in state)
+    return state
+
+
+def _train_generator(generator, optimizer_class, optimizer_defaults, optimizer_state, previous_generator, batches,
+                     results, active_classes, task, num_threads, seed):
+    '''Train [generator] on the batches received through [batches] until None is received (run in worker process).
+
+    Replay is drawn from [previous_generator] (if not None). After each batch its loss-dict is put in [results], and
+    at the end the trained parameters and optimizer-state (moved to cpu) are put in [results]. As a spawned process
+    does not inherit the random state of its parent, the random-modules are seeded with [seed].'''
+    try:
+        torch.manual_seed(seed)
+        np.random.seed(seed)
+        if num_threads is not None:
+            torch.set_num_threads(num_threads)
+        generator.optim_list = [{'params': [p for p in generator.parameters() if p.requires_grad]}]
+        generator.optimizer = optimizer_class(generator.optim_list, **optimizer_defaults)
+        generator.optimizer.load_state_dict(optimizer_state)
+        device = generator._device()
+        batch_index = 0
+        for batch in iter(batches.get, None):
+            batch_index += 1
+            x, y = batch[0].to(device), batch[1].to(device)
+            x_ = None if previous_generator is None else previous_generator.sample(x.size(0))
+            loss_dict = generator.train_a_batch(x, y, x_=x_, active_classes=active_classes, task=task, rnt=1./task)
+            results.put(("loss", batch_index, loss_dict))
+        results.put(("done", _to_cpu(generator.state_dict()), _to_cpu(generator.optimizer.state_dict())))
+    except Exception:
+        results.put(("error", traceback.format_exc()))
+
+
+class _GeneratorWorker(object):
+    '''Train [generator] on the current task in a separate process, with replay drawn from [previous_generator].
+
+    Batches of the current task are sent with [put]. Upon [finish], the trained parameters and optimizer-state are
+    loaded back into [generator]. During training the intra-op threads are split between both processes. While
+    waiting for the worker, it is checked every [poll_interval] seconds whether it is still alive.'''
+
+    poll_interval = 5.
+
+    def __init__(self, generator, previous_generator, active_classes, task, seed=0):
+        context = torch.multiprocessing.get_context("spawn")
+        self.generator = generator
+        self.batches = context.Queue(maxsize=8)
+        self.results = context.Queue()
+        # -the optimizer (and its list of parameters) cannot be sent, so it is re-created in the worker process
+        self.worker_generator = copy.deepcopy(generator, memo={id(generator.optimizer): None,
+                                                               id(generator.optim_list): []})
+        self.num_threads = torch.get_num_threads()
+        torch.set_num_threads(max(1, self.num_threads-self.num_threads//2))
+        self.process = context.Process(target=_train_generator, args=(
+            self.worker_generator, type(generator.optimizer), generator.optimizer.defaults,
+            generator.optimizer.state_dict(), previous_generator, self.batches, self.results, active_classes, task,
+            max(1, self.num_threads//2), seed,
+        ), daemon=True)
+        self.process.start()
+
+    def _check_alive(self):
+        if not self.process.is_alive():
+            raise RuntimeError("Worker process training the generator exited unexpectedly (exitcode: {}).".format(
+                self.process.exitcode
+            ))
+
+    def _send(self, item):
+        while True:
+            try:
+                self.batches.put(item, timeout=self.poll_interval)
+                return
+            except queue.Full:
+                self._check_alive()
+
+    def _receive(self, block):
+        if block:
+            while True:
+                alive = self.process.is_alive()  #--> checked before waiting, so results sent before exit are received
+                try:
+                    message = self.results.get(timeout=self.poll_interval)
+                    break
+                except queue.Empty:
+                    if not alive:
+                        self._check_alive()
+        else:
+            message = self.results.get(block=False)
+        if message[0]=="error":
+            raise RuntimeError("Training generator in worker process failed:\n{}".format(message[1]))
+        return message
+
+    def put(self, x, y):
+        self._send((x.cpu(), y.cpu()))
+
+    def losses(self):
+        '''Return <list> with tuple (batch_index, loss_dict) for each batch that is finished since the previous call.'''
+        losses = []
+        while not self.results.empty():
+            losses.append(self._receive(block=False)[1:])
+        return losses
+
+    def finish(self):
+        '''Wait for worker to finish, load results into [generator] and return <list> with remaining losses.'''
+        try:
+            self._send(None)
+            losses = []
+            message = self._receive(block=True)
+            while message[0]=="loss":
+                losses.append(message[1:])
+                message = self._receive(block=True)
+            self.generator.load_state_dict(message[1])
+            self.generator.optimizer.load_state_dict(message[2])
+            self.process.join()
+        finally:
+            if self.process.is_alive():
+                self.process.terminate()
+            torch.set_num_threads(self.num_threads)
+        return losses
+
+
 #added Test_datasets for Evaluation                                                                                       #default was iters= 2000
 def train_cl(model, train_datasets,test_datasets, result_list, original_datasets= None, replay_mode="none", scenario="class",classes_per_task=None,iters=200,batch_size=32,
              generator=None, gen_iters=0, gen_loss_cbs=list(), loss_cbs=list(), eval_cbs=list(), sample_cbs=list(),
-             use_exemplars=True, add_exemplars=False, metric_cbs=list()):
+             use_exemplars=True, add_exemplars=False, metric_cbs=list(), num_workers=0, prefetch=0, teacher_dtype=None,
+             cache_teacher=False, pool_size=0, pool_chunk=1000, pool_refresh=None, generator_worker=False, seed=0):
     '''Train a model (with a "train_a_batch" method) on multiple tasks, with replay-strategy specified by [replay_mode].
 
     [model]             <nn.Module> main model to optimize across all tasks
@@ -23,7 +204,20 @@ def train_cl(model, train_datasets,test_datasets, result_list, original_datasets
     [classes_per_task]  <int>, # of classes per task
     [iters]             <int>, # of optimization-steps (i.e., # of batches) per task
     [generator]         None or <nn.Module>, if a seperate generative model should be trained (for [gen_iters] per task)
-    [*_cbs]             <list> of call-back functions to evaluate training-progress'''
+    [*_cbs]             <list> of call-back functions to evaluate training-progress
+    [num_workers]       <int>, # of worker processes per data-loader (these persist throughout each task)
+    [prefetch]          <int>, # of batches to prepare in advance in a background thread (if 0, no background thread)
+    [teacher_dtype]     None or <torch.dtype>, to which the copy of the model used for replay is converted
+    [cache_teacher]     <bool>, if previous model is only used to score fixed data (i.e., current data with "current"
+                            replay or binary distillation, or stored data with "exact"/"exemplars" replay with soft
+                            targets), should it score all these samples at once (at start of task / upon storing)?
+    [pool_size]         <int>, if >0 and "generative" replay, replay is drawn from pool of this many samples generated
+                            (and scored) in chunks of [pool_chunk]; if 0, samples are generated for every batch
+    [pool_refresh]      None or <int>, # of samples in the pool to be replaced (in background thread) per drawn batch
+                            (if None, [batch_size])
+    [generator_worker]  <bool>, should [generator] be trained in a separate process (with its own generative replay)?
+                            (if so, [sample_cbs] are not called for [generator])
+    [seed]              <int>, random seed (used to seed the worker process of [generator_worker] for each task)'''
 
 
     # Set model in training-mode
@@ -39,10 +233,13 @@ def train_cl(model, train_datasets,test_datasets, result_list, original_datasets
 
     # Register starting param-values (needed for "intelligent synapses").
     if isinstance(model, ContinualLearner) and (model.si_c>0):
-        for n, p in model.named_parameters():
-            if p.requires_grad:
-                n = n.replace('.', '__')
-                model.register_buffer('{}_SI_prev_task'.format(n), p.data.clone())
+        if model.param_arena is not None:
+            model.register_buffer('SI_prev_task', model.param_arena.clone())
+        else:
+            for n, p in model.named_parameters():
+                if p.requires_grad:
+                    n = n.replace('.', '__')
+                    model.register_buffer('{}_SI_prev_task'.format(n), p.data.clone())
 
     # Loop over all tasks. {TRAINING REALLY BEGINS, for each of the task's train_dataset}
     for task, train_dataset in enumerate(train_datasets, 1):
@@ -65,13 +262,19 @@ def train_cl(model, train_datasets,test_datasets, result_list, original_datasets
 
         # Prepare <dicts> to store running importance estimates and param-values before update ("Synaptic Intelligence")
         if isinstance(model, ContinualLearner) and (model.si_c>0):
-            W = {}
-            p_old = {}
-            for n, p in model.named_parameters():
-                if p.requires_grad:
-                    n = n.replace('.', '__')
-                    W[n] = p.data.clone().zero_()
-                    p_old[n] = p.data.clone()
+            if model.param_arena is not None:
+                # -with parameter arena, these are flat <tensors> (plus buffer for parameter-change, re-used every step)
+                W = torch.zeros_like(model.param_arena)
+                p_old = model.param_arena.clone()
+                p_change = torch.empty_like(model.param_arena)
+            else:
+                W = {}
+                p_old = {}
+                for n, p in model.named_parameters():
+                    if p.requires_grad:
+                        n = n.replace('.', '__')
+                        W[n] = p.data.clone().zero_()
+                        p_old[n] = p.data.clone()
 
         # Find [active_classes]
         active_classes = None  # -> for Domain-IL scenario, always all classes are active
@@ -88,65 +291,108 @@ def train_cl(model, train_datasets,test_datasets, result_list, original_datasets
         if (generator is not None) and generator.optim_type=="adam_reset":
             generator.optimizer = optim.Adam(model.optim_list, betas=(0.9, 0.999))
 
-        # Initialize # iters left on current data-loader(s)
-        iters_left = iters_left_previous = 1
-        if scenario=="task":
-            up_to_task = task if replay_mode=="offline" else task-1
-            iters_left_previous = [1]*up_to_task
-            data_loader_previous = [None]*up_to_task
+        # If --bce, --bce-distill & scenario=="class", scores of current batch are needed from previous model
+        binary_distillation = hasattr(model, "binaryCE") and model.binaryCE and model.binaryCE_distill
+
+        # If requested, let previous model score all samples of current task at once (as neither changes during task)
+        # -only possible if scores do not depend on a task-specific mask
+        loading_dataset = training_dataset
+        if cache_teacher and (previous_model is not None) and (Current or (
+                binary_distillation and scenario=="class"
+        )) and ((not hasattr(previous_model, "mask_dict")) or (previous_model.mask_dict is None)):
+            loading_dataset = ScoredDataset(training_dataset, utils.get_model_scores(previous_model, training_dataset,
+                                                                                     cuda=cuda))
+
+        # Create data-loader(s) that endlessly yield shuffled batches (so they only need to be created once per task)
+        data_loader = data_loader_previous = task_ids_ = None
+        if not (replay_mode=="offline" and scenario=="task"):
+            data_loader = iter(utils.get_infinite_data_loader(loading_dataset, batch_size, cuda=cuda,
+                                                              num_workers=num_workers))
+            # NOTE:  [train_dataset]  is training-set of current task
+            #      [training_dataset] is training-set of current task with stored exemplars added (if requested)
+        if Exact:
+            if scenario=="task":
+                # -in Task-IL scenario, need separate replay for each task
+                up_to_task = task if replay_mode=="offline" else task-1
+                batch_size_replay = int(np.ceil(batch_size/up_to_task)) if (up_to_task>1) else batch_size
+                batch_sizes_replay = [min(batch_size_replay, len(previous_datasets[task_id])) for task_id in range(
+                    up_to_task
+                )]
+                if model.label=="Classifier" and (model.mask_dict is None) and not any(
+                        isinstance(module, torch.nn.BatchNorm1d) for module in model.modules()
+                ):
+                    # -if there are no task-specific masks, replay all tasks in single batch with task-id per sample
+                    #  (not with batch-norm, as its statistics would then be computed over the replay of all tasks)
+                    data_loader_previous = iter(utils.get_infinite_stratified_data_loader(
+                        previous_datasets[:up_to_task], batch_sizes_replay, cuda=cuda, num_workers=num_workers,
+                    ))
+                    task_ids_ = torch.repeat_interleave(
+                        torch.arange(up_to_task), torch.tensor(batch_sizes_replay)
+                    ).to(device)
+                else:
+                    data_loader_previous = [iter(utils.get_infinite_data_loader(
+                        previous_datasets[task_id], batch_sizes_replay[task_id], cuda=cuda, num_workers=num_workers,
+                    )) for task_id in range(up_to_task)]
+            else:
+                previous_dataset = previous_datasets[0] if len(previous_datasets)==1 else ConcatDataset(previous_datasets)
+                data_loader_previous = iter(utils.get_infinite_data_loader(
+                    previous_dataset, min(batch_size, len(previous_dataset)), cuda=cuda, num_workers=num_workers
+                ))
+
+        # Prepare to collect batches (if requested, in a background thread while the model is trained on previous batch)
+        collect_batches = functools.partial(
+            _collect_batches, data_loader, data_loader_previous, device=device,
+            y_offset=classes_per_task*(task-1) if scenario=="task" else 0,
+            y_offsets_previous=[classes_per_task*task_id for task_id in range(task)] if (
+                task_ids_ is None
+            ) else classes_per_task*task_ids_,
+        )
+        batches = utils.BackgroundPrefetcher(collect_batches, queue_size=prefetch) if prefetch>0 else None
+
+        # If requested, draw generative replay from pool of samples that are generated and scored in large chunks
+        # -only possible if scores do not depend on a task-specific mask
+        replay_pool = None
+        if Generative and pool_size>0 and (
+                (not hasattr(previous_model, "mask_dict")) or (previous_model.mask_dict is None)
+        ):
+            replay_pool = utils.ReplayPool(
+                functools.partial(_generate_replay, previous_generator, previous_model), pool_size=pool_size,
+                chunk_size=pool_chunk, refresh=batch_size if (pool_refresh is None) else pool_refresh,
+            )
 
         # Define tqdm progress bar(s)
         progress = tqdm.tqdm(range(1, iters+1))
         if generator is not None:
             progress_gen = tqdm.tqdm(range(1, gen_iters+1))
 
+        # If requested, train the generator in a separate process (it is only used for replay after this task)
+        worker = None
+        if generator is not None and generator_worker and gen_iters>0:
+            worker = _GeneratorWorker(generator, previous_generator if Generative else None,
+                                      active_classes=active_classes, task=task, seed=seed+task)
+
         # Loop over all iterations
         iters_to_use = iters if (generator is None) else max(iters, gen_iters)
         for batch_index in range(1, iters_to_use+1):
 
-            # Update # iters left on current data-loader(s) and, if needed, create new one(s)
-            iters_left -= 1
-            if iters_left==0:
-                data_loader = iter(utils.get_data_loader(training_dataset, batch_size, cuda=cuda, drop_last=True))
-                # NOTE:  [train_dataset]  is training-set of current task
-                #      [training_dataset] is training-set of current task with stored exemplars added (if requested)
-                iters_left = len(data_loader)
-            if Exact:
-                if scenario=="task":
-                    up_to_task = task if replay_mode=="offline" else task-1
-                    batch_size_replay = int(np.ceil(batch_size/up_to_task)) if (up_to_task>1) else batch_size
-                    # -in Task-IL scenario, need separate replay for each task
-                    for task_id in range(up_to_task):
-                        batch_size_to_use = min(batch_size_replay, len(previous_datasets[task_id]))
-                        iters_left_previous[task_id] -= 1
-                        if iters_left_previous[task_id]==0:
-                            data_loader_previous[task_id] = iter(utils.get_data_loader(
-                                previous_datasets[task_id], batch_size_to_use, cuda=cuda, drop_last=True
-                            ))
-                            iters_left_previous[task_id] = len(data_loader_previous[task_id])
-                else:
-                    iters_left_previous -= 1
-                    if iters_left_previous==0:
-                        batch_size_to_use = min(batch_size, len(ConcatDataset(previous_datasets)))
-                        data_loader_previous = iter(utils.get_data_loader(ConcatDataset(previous_datasets),
-                                                                          batch_size_to_use, cuda=cuda, drop_last=True))
-                        iters_left_previous = len(data_loader_previous)
-
-
             # -----------------Collect data------------------#
 
+            # Sample training data of current task (and, if 'exact' replay, of previous tasks) on correct device
+            x, y, teacher_scores, x_exact, y_exact, scores_exact = next(batches) if (
+                batches is not None
+            ) else collect_batches()
+
             #####-----CURRENT BATCH-----#####
             if replay_mode=="offline" and scenario=="task":
                 x = y = scores = None
             else:
-                x, y = next(data_loader)                                    #--> sample training data of current task
-                y = y-classes_per_task*(task-1) if scenario=="task" else y  #--> ITL: adjust y-targets to 'active range'
-                x, y = x.to(device), y.to(device)                           #--> transfer them to correct device
                 # If --bce, --bce-distill & scenario=="class", calculate scores of current batch with previous model
-                binary_distillation = hasattr(model, "binaryCE") and model.binaryCE and model.binaryCE_distill
                 if binary_distillation and scenario=="class" and (previous_model is not None):
-                    with torch.no_grad():
-                        scores = previous_model(x)[:, :(classes_per_task * (task - 1))]
+                    if teacher_scores is not None:
+                        scores = teacher_scores[:, :(classes_per_task * (task - 1))]
+                    else:
+                        with torch.no_grad():
+                            scores = _predict_scores(previous_model, x, list(range(classes_per_task * (task - 1))))
                 else:
                     scores = None
 
@@ -159,47 +405,65 @@ def train_cl(model, train_datasets,test_datasets, result_list, original_datasets
             if Exact:
                 scores_ = None
                 if scenario in ("domain", "class"):
-                    # Sample replayed training data, move to correct device
-                    x_, y_ = next(data_loader_previous)
-                    x_ = x_.to(device)
-                    y_ = y_.to(device) if (model.replay_targets=="hard") else None
+                    # Replayed training data (already on correct device)
+                    x_ = x_exact
+                    y_ = y_exact if (model.replay_targets=="hard") else None
                     # If required, get target scores (i.e, [scores_]         -- using previous model, with no_grad()
-                    if (model.replay_targets=="soft"):
+                    if (model.replay_targets=="soft") and (scores_exact is not None):
+                        scores_ = scores_exact
+                    elif (model.replay_targets=="soft"):
                         with torch.no_grad():
-                            scores_ = previous_model(x_)
-                        scores_ = scores_[:, :(classes_per_task*(task-1))] if scenario=="class" else scores_
+                            scores_ = _predict_scores(previous_model, x_, list(range(classes_per_task*(task-1))) if (
+                                scenario=="class"
+                            ) else None)
                         #-> when scenario=="class", zero probabilities will be added in the [utils.loss_fn_kd]-function
+                elif scenario=="task" and (task_ids_ is not None):
+                    # Replayed training data of all tasks in single batch (already on correct device)
+                    x_ = x_exact
+                    y_ = y_exact if (model.replay_targets=="hard") else None
+                    # If required, get target scores (i.e, [scores_]         -- using previous model, with no_grad()
+                    # -for each replayed sample, only the scores for the classes of its task are collected
+                    if (model.replay_targets=="soft") and (scores_exact is not None):
+                        scores_ = scores_exact
+                    elif (model.replay_targets=="soft") and (previous_model is not None):
+                        with torch.no_grad():
+                            scores_ = previous_model(x_)
+                        scores_ = scores_.gather(1, (classes_per_task*task_ids_).unsqueeze(1) + torch.arange(
+                            classes_per_task, device=device
+                        ))
                 elif scenario=="task":
-                    # Sample replayed training data, wrap in (cuda-)Variables and store in lists
-                    x_ = list()
-                    y_ = list()
+                    # Replayed training data (already on correct device), in lists with entry per task
+                    x_ = x_exact
                     up_to_task = task if replay_mode=="offline" else task-1
-                    for task_id in range(up_to_task):
-                        x_temp, y_temp = next(data_loader_previous[task_id])
-                        x_.append(x_temp.to(device))
-                        # -only keep [y_] if required (as otherwise unnecessary computations will be done)
-                        if model.replay_targets=="hard":
-                            y_temp = y_temp - (classes_per_task*task_id) #-> adjust y-targets to 'active range'
-                            y_.append(y_temp.to(device))
-                        else:
-                            y_.append(None)
+                    # -only keep [y_] if required (as otherwise unnecessary computations will be done)
+                    y_ = y_exact if (model.replay_targets=="hard") else [None]*up_to_task
                     # If required, get target scores (i.e, [scores_]         -- using previous model
-                    if (model.replay_targets=="soft") and (previous_model is not None):
+                    if (model.replay_targets=="soft") and (scores_exact is not None):
+                        scores_ = scores_exact
+                    elif (model.replay_targets=="soft") and (previous_model is not None):
                         scores_ = list()
                         for task_id in range(up_to_task):
                             with torch.no_grad():
-                                scores_temp = previous_model(x_[task_id])
-                            scores_temp = scores_temp[:, (classes_per_task*task_id):(classes_per_task*(task_id+1))]
+                                scores_temp = _predict_scores(previous_model, x_[task_id], list(
+                                    range(classes_per_task*task_id, classes_per_task*(task_id+1))
+                                ))
                             scores_.append(scores_temp)
 
             ##-->> Generative / Current Replay <<--##
             if Generative or Current:
-                # Get replayed data (i.e., [x_]) -- either current data or use previous generator
-                x_ = x if Current else previous_generator.sample(batch_size)
+                # Get replayed data (i.e., [x_]) -- either current data or use previous generator (or pool)
+                if replay_pool is not None:
+                    x_, all_scores_ = replay_pool.draw(batch_size)
+                else:
+                    x_ = x if Current else previous_generator.sample(batch_size)
 
                 # Get target scores and labels (i.e., [scores_] / [y_]) -- using previous model, with no_grad()
                 # -if there are no task-specific mask, obtain all predicted scores at once
-                if (not hasattr(previous_model, "mask_dict")) or (previous_model.mask_dict is None):
+                if Current and (teacher_scores is not None):
+                    all_scores_ = teacher_scores
+                elif (replay_pool is None) and (
+                        (not hasattr(previous_model, "mask_dict")) or (previous_model.mask_dict is None)
+                ):
                     with torch.no_grad():
                         all_scores_ = previous_model(x_)
                 # -depending on chosen scenario, collect relevant predicted scores (per task, if required)
@@ -213,12 +477,17 @@ def train_cl(model, train_datasets,test_datasets, result_list, original_datasets
                     # -[x_] needs to be evaluated according to each previous task, so make list with entry per task
                     scores_ = list()
                     y_ = list()
+                    # -if there is a task-mask (i.e., XdG is used), obtain predicted scores for all tasks in one forward
+                    #  pass, with for each copy of [x_] the mask of the task according to which it is evaluated
+                    if hasattr(previous_model, "mask_dict") and previous_model.mask_dict is not None:
+                        with torch.no_grad():
+                            all_scores_per_task_ = previous_model(
+                                torch.cat([x_]*(task-1)),
+                                task_ids=torch.arange(1, task, device=x_.device).repeat_interleave(x_.size(0)),
+                            ).split(x_.size(0))
                     for task_id in range(task - 1):
-                        # -if there is a task-mask (i.e., XdG is used), obtain predicted scores for each task separately
                         if hasattr(previous_model, "mask_dict") and previous_model.mask_dict is not None:
-                            previous_model.apply_XdGmask(task=task_id + 1)
-                            with torch.no_grad():
-                                all_scores_ = previous_model(x_)
+                            all_scores_ = all_scores_per_task_[task_id]
                         if scenario=="domain":
                             temp_scores_ = all_scores_
                         else:
@@ -238,10 +507,15 @@ def train_cl(model, train_datasets,test_datasets, result_list, original_datasets
 
                 # Train the main model with this batch
                 loss_dict = model.train_a_batch(x, y, x_=x_, y_=y_, scores=scores, scores_=scores_,
-                                                active_classes=active_classes, task=task, rnt = 1./task)
+                                                active_classes=active_classes, task=task, rnt = 1./task,
+                                                task_ids_=task_ids_)
 
                 # Update running parameter importance estimates in W
-                if isinstance(model, ContinualLearner) and (model.si_c>0):
+                if isinstance(model, ContinualLearner) and (model.si_c>0) and (model.param_arena is not None):
+                    torch.sub(model.param_arena, p_old, out=p_change)
+                    W.addcmul_(model.grad_arena, p_change, value=-1)
+                    p_old.copy_(model.param_arena)
+                elif isinstance(model, ContinualLearner) and (model.si_c>0):
                     for n, p in model.named_parameters():
                         if p.requires_grad:
                             n = n.replace('.', '__')
@@ -262,8 +536,20 @@ def train_cl(model, train_datasets,test_datasets, result_list, original_datasets
                             sample_cb(model, batch_index, task=task)
 
 
+            #---> Train GENERATOR (in separate process)
+            if worker is not None and batch_index <= gen_iters:
+
+                # Send this batch to the worker process
+                worker.put(x, y)
+
+                # Fire callbacks for each batch the generator has finished
+                for gen_batch_index, loss_dict in worker.losses():
+                    for loss_cb in gen_loss_cbs:
+                        if loss_cb is not None:
+                            loss_cb(progress_gen, gen_batch_index, loss_dict, task=task)
+
             #---> Train GENERATOR
-            if generator is not None and batch_index <= gen_iters:
+            elif generator is not None and batch_index <= gen_iters:
 
                 # Train the generator with this batch
                 loss_dict = generator.train_a_batch(x, y, x_=x_, y_=y_, scores_=scores_, active_classes=active_classes,
@@ -280,6 +566,19 @@ def train_cl(model, train_datasets,test_datasets, result_list, original_datasets
 
         ##----------> UPON FINISHING EACH TASK...
 
+        # Wait for worker process training the generator (if used)
+        if worker is not None:
+            for gen_batch_index, loss_dict in worker.finish():
+                for loss_cb in gen_loss_cbs:
+                    if loss_cb is not None:
+                        loss_cb(progress_gen, gen_batch_index, loss_dict, task=task)
+
+        # Stop background threads collecting batches and generating replay (if used)
+        if batches is not None:
+            batches.close()
+        if replay_pool is not None:
+            replay_pool.close()
+
         # Close progres-bar(s)
         progress.close()
         if generator is not None:
@@ -361,10 +660,10 @@ def train_cl(model, train_datasets,test_datasets, result_list, original_datasets
                 metric_cb(model, iters, task=task)
 
         # REPLAY: update source for replay
-        previous_model = copy.deepcopy(model).eval()
+        previous_model = model.snapshot_for_replay(dtype=teacher_dtype if model.label=="Classifier" else None)
         if replay_mode == 'generative':
             Generative = True
-            previous_generator = copy.deepcopy(generator).eval() if generator is not None else previous_model
+            previous_generator = generator.snapshot_for_replay() if generator is not None else previous_model
         elif replay_mode == 'current':
             Current = True
         elif replay_mode in ('exemplars', 'exact'):
@@ -385,3 +684,15 @@ def train_cl(model, train_datasets,test_datasets, result_list, original_datasets
                     target_transform = (lambda y, x=classes_per_task: y % x) if scenario == "domain" else None
                     previous_datasets = [
                         ExemplarDataset(model.exemplar_sets, target_transform=target_transform)]
+            # -if requested, store with replayed samples the scores of previous model (i.e., for soft targets)
+            #  (only possible if scores do not depend on a task-specific mask)
+            if cache_teacher and model.replay_targets=="soft" and model.label=="Classifier" and (
+                    previous_model.mask_dict is None
+            ):
+                for task_id, previous_dataset in enumerate(previous_datasets):
+                    scores = utils.get_model_scores(previous_model, previous_dataset, cuda=cuda)
+                    if scenario=="task":
+                        scores = scores[:, (classes_per_task*task_id):(classes_per_task*(task_id+1))]
+                    elif scenario=="class":
+                        scores = scores[:, :(classes_per_task*task)]
+                    previous_datasets[task_id] = ScoredDataset(previous_dataset, scores.contiguous())
@@ -1,8 +1,10 @@
 import numpy as np
 import pickle
+import queue
+import threading
 import torch
 from torch import nn
-from torch.utils.data import DataLoader
+from torch.utils.data import DataLoader, ConcatDataset, BatchSampler, RandomSampler, SequentialSampler
 from torch.utils.data.dataloader import default_collate
 from torch.nn import functional as F
 from torchvision import transforms
@@ -15,11 +17,13 @@ from vae_models import AutoEncoder
 ## Loss function ##
 ###################
 
-def loss_fn_kd(scores, target_scores, T=2.):
+def loss_fn_kd(scores, target_scores, T=2., weights=None):
     """Compute knowledge-distillation (KD) loss given [scores] and [target_scores].
 
     Both [scores] and [target_scores] should be tensors, although [target_scores] should be repackaged.
-    'Hyperparameter': temperature"""
+    'Hyperparameter': temperature
+    If [weights] (<tensor> with weight per sample) is provided, the weighted sum (instead of the mean) over the batch
+    is taken."""
 
     device = scores.device
 
@@ -37,7 +41,8 @@ def loss_fn_kd(scores, target_scores, T=2.):
     # Calculate distillation loss (see e.g., Li and Hoiem, 2017)
     KD_loss_unnorm = -(targets_norm * log_scores_norm)
     KD_loss_unnorm = KD_loss_unnorm.sum(dim=1)                      #--> sum over classes
-    KD_loss_unnorm = KD_loss_unnorm.mean()                          #--> average over batch
+    KD_loss_unnorm = KD_loss_unnorm.mean() if (weights is None) else (weights*KD_loss_unnorm).sum()
+    #--> (weighted) average over batch
 
     # normalize
     KD_loss = KD_loss_unnorm * T**2
@@ -45,11 +50,13 @@ def loss_fn_kd(scores, target_scores, T=2.):
     return KD_loss
 
 
-def loss_fn_kd_binary(scores, target_scores, T=2.):
+def loss_fn_kd_binary(scores, target_scores, T=2., weights=None):
     """Compute binary knowledge-distillation (KD) loss given [scores] and [target_scores].
 
     Both [scores] and [target_scores] should be tensors, although [target_scores] should be repackaged.
-    'Hyperparameter': temperature"""
+    'Hyperparameter': temperature
+    If [weights] (<tensor> with weight per sample) is provided, the weighted sum (instead of the mean) over the batch
+    is taken."""
 
     device = scores.device
 
@@ -67,7 +74,8 @@ def loss_fn_kd_binary(scores, target_scores, T=2.):
     # Calculate distillation loss
     KD_loss_unnorm = -( targets_norm * torch.log(scores_norm) + (1-targets_norm) * torch.log(1-scores_norm) )
     KD_loss_unnorm = KD_loss_unnorm.sum(dim=1)      #--> sum over classes
-    KD_loss_unnorm = KD_loss_unnorm.mean()          #--> average over batch
+    KD_loss_unnorm = KD_loss_unnorm.mean() if (weights is None) else (weights*KD_loss_unnorm).sum()
+    #--> (weighted) average over batch
 
     # normalize
     KD_loss = KD_loss_unnorm * T**2
@@ -75,6 +83,23 @@ def loss_fn_kd_binary(scores, target_scores, T=2.):
     return KD_loss
 
 
+def loss_value(loss_fn):
+    '''Return the value (as <float>) of the loss computed by [loss_fn], without keeping track of gradients.'''
+    with torch.no_grad():
+        return loss_fn().item()
+
+
+class LazyDict(dict):
+    '''<dict> in which values that are functions (without arguments) are only evaluated when first accessed.'''
+
+    def __getitem__(self, key):
+        value = super().__getitem__(key)
+        if callable(value):
+            value = value()
+            self[key] = value
+        return value
+
+
 ##-------------------------------------------------------------------------------------------------------------------##
 
 
@@ -82,6 +107,25 @@ def loss_fn_kd_binary(scores, target_scores, T=2.):
 ## Data-handling functions ##
 #############################
 
+def _prepare_loading(dataset, collate_fn=None):
+    '''Return tuple with <DataSet> to load samples from, [collate_fn] and whether whole batches are loaded at once.
+
+    If pixels are permuted (permMNIST), un-permuted samples are loaded and each collated batch is permuted with a single
+    gather. If [dataset] can return whole batches (e.g., <TensorCacheDataset>), it is indexed with batch-indeces.'''
+
+    permute_batch = None
+    if isinstance(dataset, data.PermutedDataset):
+        permute_batch = dataset.permute_batch
+        dataset = dataset.unpermuted
+
+    if collate_fn is None and data.supports_batch_indexing(dataset):
+        return (dataset, permute_batch, True)
+    collate_fn = collate_fn or default_collate
+    if permute_batch is not None:
+        collate_fn = (lambda batch, collate=collate_fn: permute_batch(collate(batch)))
+    return (dataset, collate_fn, False)
+
+
 def get_data_loader(dataset, batch_size, cuda=False, collate_fn=None, drop_last=False, augment=False):
     '''Return <DataLoader>-object for the provided <DataSet>-object [dataset].'''
 
@@ -92,14 +136,186 @@ def get_data_loader(dataset, batch_size, cuda=False, collate_fn=None, drop_last=
     else:
         dataset_ = dataset
 
+    # If possible, load whole batches at once (and permute pixels per batch)
+    dataset_, collate_fn, batch_indexing = _prepare_loading(dataset_, collate_fn=collate_fn)
+    if batch_indexing:
+        batch_sampler = BatchSampler(RandomSampler(dataset_), batch_size=batch_size, drop_last=drop_last)
+        return DataLoader(dataset_, sampler=batch_sampler, batch_size=None, collate_fn=collate_fn,
+                          **({'num_workers': 0, 'pin_memory': True} if cuda else {}))
+
     # Create and return the <DataLoader>-object
     return DataLoader(
-        dataset_, batch_size=batch_size, shuffle=True,
-        collate_fn=(collate_fn or default_collate), drop_last=drop_last,
+        dataset_, batch_size=batch_size, shuffle=True, collate_fn=collate_fn, drop_last=drop_last,
         **({'num_workers': 0, 'pin_memory': True} if cuda else {})
     )
 
 
+def get_infinite_data_loader(dataset, batch_size, cuda=False, collate_fn=None, num_workers=0):
+    '''Return <DataLoader>-object for [dataset] that endlessly yields shuffled batches of size [batch_size].
+
+    At each epoch boundary a new random order is drawn without re-creating the data-loader or its iterator, so it only
+    needs to be created once per data-source (and if [num_workers]>0, worker processes persist as long as its iterator).
+    Samples that do not fill a complete batch at the end of an epoch are skipped.'''
+
+    dataset_, collate_fn, batch_indexing = _prepare_loading(dataset, collate_fn=collate_fn)
+    batch_sampler = data.InfiniteBatchSampler(len(dataset_), batch_size)
+    if batch_indexing:
+        return DataLoader(dataset_, sampler=batch_sampler, batch_size=None, collate_fn=collate_fn,
+                          num_workers=num_workers, pin_memory=cuda)
+    return DataLoader(dataset_, batch_sampler=batch_sampler, collate_fn=collate_fn, num_workers=num_workers,
+                      pin_memory=cuda)
+
+
+def get_infinite_stratified_data_loader(datasets, batch_sizes, cuda=False, collate_fn=None, num_workers=0):
+    '''Return <DataLoader>-object that endlessly yields batches with [batch_sizes][i] samples from [datasets][i].
+
+    Within each batch, the samples are ordered per dataset (i.e., first those from [datasets][0], etc.), and for each
+    dataset samples are drawn as in [get_infinite_data_loader]. If all [datasets] can return whole batches (e.g.,
+    <ExemplarDataset> or permuted <TensorCacheDataset>), they are indexed with batch-indeces.'''
+
+    batch_sampler = data.InfiniteStratifiedBatchSampler([len(d) for d in datasets], batch_sizes)
+    if collate_fn is None and all(data.supports_batch_indexing(d) for d in datasets):
+        return DataLoader(data.ConcatBatchDataset(datasets), sampler=batch_sampler, batch_size=None,
+                          num_workers=num_workers, pin_memory=cuda)
+    dataset = ConcatDataset(datasets)
+    return DataLoader(dataset, batch_sampler=batch_sampler, collate_fn=collate_fn, num_workers=num_workers,
+                      pin_memory=cuda)
+
+
+def get_model_scores(model, dataset, batch_size=256, cuda=False):
+    '''Return <tensor> (on cpu) with for each sample in [dataset] (in order) the scores predicted by [model].
+
+    Samples are run through [model] in batches of [batch_size], without computing gradients.'''
+
+    dataset_, collate_fn, batch_indexing = _prepare_loading(dataset)
+    batch_sampler = BatchSampler(SequentialSampler(dataset_), batch_size=batch_size, drop_last=False)
+    if batch_indexing:
+        data_loader = DataLoader(dataset_, sampler=batch_sampler, batch_size=None, collate_fn=collate_fn,
+                                 pin_memory=cuda)
+    else:
+        data_loader = DataLoader(dataset_, batch_sampler=batch_sampler, collate_fn=collate_fn, pin_memory=cuda)
+    device = model._device()
+    scores = []
+    with torch.no_grad():
+        for x, _ in data_loader:
+            scores.append(model(x.to(device)).cpu())
+    return torch.cat(scores)
+
+
+class BackgroundPrefetcher(object):
+    '''Iterator that repeatedly calls [fetch_fn] in a background thread, keeping up to [queue_size] results ready.
+
+    Call [close] to stop the background thread (e.g., at the end of each task).'''
+
+    def __init__(self, fetch_fn, queue_size=2):
+        self.fetch_fn = fetch_fn
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.stop_event = threading.Event()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        try:
+            while not self.stop_event.is_set():
+                self._put((self.fetch_fn(), None))
+        except Exception as exception:
+            # -pass on exception, so that it is raised in the main thread
+            self._put((None, exception))
+
+    def _put(self, item):
+        # -use a timeout, so that a request to stop is noticed while the queue is full
+        while not self.stop_event.is_set():
+            try:
+                self.queue.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                continue
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        (item, exception) = self.queue.get()
+        if exception is not None:
+            self.close()
+            raise exception
+        return item
+
+    def close(self):
+        self.stop_event.set()
+        self.thread.join()
+
+
+class ReplayPool(object):
+    '''Pool of replayed samples that are generated in large chunks, from which batches are drawn at random.
+
+    [sample_fn] should return a tuple of <tensors> (e.g., generated inputs and the scores predicted for them) for a
+    requested number of samples. Upon creation the pool is filled with [pool_size] samples, after which it is used as a
+    ring-buffer: for each drawn batch, [refresh] samples become due to be replaced by new ones. These are generated in
+    chunks of [chunk_size] samples in a background thread, so generation can overlap with training.
+
+    Call [close] to stop the background thread (e.g., at the end of each task).'''
+
+    def __init__(self, sample_fn, pool_size, chunk_size=1000, refresh=0):
+        self.sample_fn = sample_fn
+        self.pool_size = pool_size
+        self.chunk_size = min(chunk_size, pool_size)
+        self.refresh = refresh
+        # -fill the pool (in chunks)
+        chunks = [sample_fn(min(self.chunk_size, pool_size-start)) for start in range(0, pool_size, self.chunk_size)]
+        self.pool = [torch.cat(tensors) for tensors in zip(*chunks)]
+        self.position = 0  #--> where next chunk will be written
+        self.due = 0       #--> # of samples due to be replaced
+        self.exception = None
+        self.stopped = False
+        self.condition = threading.Condition()
+        self.thread = None
+        if refresh>0:
+            self.thread = threading.Thread(target=self._run, daemon=True)
+            self.thread.start()
+
+    def _run(self):
+        try:
+            while True:
+                with self.condition:
+                    while self.due<self.chunk_size and not self.stopped:
+                        self.condition.wait()
+                    if self.stopped:
+                        return
+                    self.due -= self.chunk_size
+                chunk = self.sample_fn(self.chunk_size)
+                with self.condition:
+                    index = (self.position + torch.arange(self.chunk_size, device=self.pool[0].device)) % self.pool_size
+                    for tensor, new_samples in zip(self.pool, chunk):
+                        tensor[index] = new_samples
+                    self.position = (self.position + self.chunk_size) % self.pool_size
+        except Exception as exception:
+            # -pass on exception, so that it is raised in the main thread
+            self.exception = exception
+
+    def draw(self, batch_size):
+        '''Return tuple of <tensors> with [batch_size] samples drawn at random from the pool.'''
+        if self.exception is not None:
+            self.close()
+            raise self.exception
+        index = torch.randint(self.pool_size, (batch_size,), device=self.pool[0].device)
+        with self.condition:
+            batch = tuple(tensor[index] for tensor in self.pool)
+            if self.thread is not None:
+                # -if generation falls behind, do not let more than the whole pool become due
+                self.due = min(self.due + self.refresh, self.pool_size)
+                self.condition.notify()
+        return batch
+
+    def close(self):
+        if self.thread is not None:
+            with self.condition:
+                self.stopped = True
+                self.condition.notify()
+            self.thread.join()
+            self.thread = None
+
+
 def label_squeezing_collate_fn(batch):
     x, y = default_collate(batch)
     return x, y.long().squeeze()
@@ -113,6 +329,24 @@ def to_one_hot(y, classes):
     return c
 
 
+def class_slice(classes):
+    '''Return <slice> with same class-indeces as <list> [classes] if these are contiguous and increasing, else None.'''
+    classes = list(classes)
+    if len(classes)>0 and classes==list(range(classes[0], classes[-1]+1)):
+        return slice(classes[0], classes[-1]+1)
+    return None
+
+
+def select_classes(scores, classes):
+    '''Return the columns of 2D-tensor [scores] for the classes in [classes] (if None, all are returned).
+
+    If [classes] are contiguous, a view is returned (so no copy is made).'''
+    if classes is None:
+        return scores
+    selection = class_slice(classes)
+    return scores[:, classes] if (selection is None) else scores[:, selection]
+
+
 ##-------------------------------------------------------------------------------------------------------------------##
 
 ##########################################